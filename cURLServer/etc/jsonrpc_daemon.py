@@ -21,10 +21,15 @@
 # THE SOFTWARE.
 
 
-import sys, time, os, shutil
+import sys, time, os, re, errno, signal, traceback
+from collections import deque
 from daemon import Daemon
-import simplejson as json
+import jsonrpc_codec as json
 import jsonrpcbase
+import jsonrpc_queue
+from jsonrpc_callback import NotifierProcess
+from jsonrpc_gc import TmpdirCollector
+import jsonrpc_procs
 from jsonrpc_procs import rpc_service_setup
 
 # Boto and the AWS access keys would be used if this were extended to
@@ -36,94 +41,409 @@ from jsonrpc_procs import rpc_service_setup
 
 # sqs_conn = ''
 
-# This holds all the tasks.  They are pulled from this directory
-# with a FIFO execution style.  The tasks are identified by the pid of
-# the requesting process.  Unless the tasks really jam up and the server
-# is rebooted, there's no chance of collision.
-local_queue_dir = '/tmp/jsonrpc_queue'
+# The queue directory and the wakeup pipe live in jsonrpc_queue.py.
+local_queue_dir = jsonrpc_queue.local_queue_dir
 
 # This holds all the temporary files for the tasks.  It is only used
-# here as the root of the cleanup process.  Each task identifies its own
+# here as a root of the cleanup process (see jsonrpc_gc.py).  Each task identifies its own
 # tmpdir whish is the home directory for the task.   This will almost always 
 # be the same as queue filename.  But there # is still the option for the 
 # user to identify a specific tmpdir to run from.
 jsonrpc_tmpdir = '/tmp/jsonrpc'
 
 
+# Async jobs run in forked worker processes, at most max_workers at a time.
+# Each worker has its own process, so each job's os.chdir() into its own
+# tmpdir can't interfere with any other job.
+max_workers = 4
+
+# Limit on the number of jobs at once that talk to any one host (found by
+# looking for URLs in the request), None for no limit.  host_limits
+# overrides it for particular hosts, e.g. {'s3.amazonaws.com': 8}.
+max_per_host = 2
+host_limits = {}
+
+# How many items may be held back waiting on busy hosts before the daemon
+# stops reading further ahead in the queue.  Their files wait in
+# jsonrpc_queue.deferred_dir until they start.
+max_deferred = 100
+
+# A job whose worker dies before it finishes (including when the daemon
+# itself is restarted) is put back in the queue to carry on from where it
+# got to, at most this many times.  See the journal in jsonrpc_procs.py.
+max_resumes = 3
+
+# A job that is still "queued" at startup but whose queue file has gone was
+# taken by the daemon and never started.  This long after its last status
+# update, that is; a younger one may be being queued right now.
+lost_job_grace = 60     # seconds
+
+url_host_re = re.compile(r'[a-zA-Z][-+.a-zA-Z0-9]*://(?:[^/@\s"]*@)?([^/:?#\s"\'\\]+)')
+
+
 rpc_service = rpc_service_setup()
 
 class JSONRPCDaemon(Daemon):
     "Daemon class for processing JSON RPC requests"
 
-    def run_an_item(self,qfile_list):
-        "Pulls an item from the queue, and sends it to the rpc_service."
-        
+    def __init__(self, *args, **kwargs):
+        Daemon.__init__(self, *args, **kwargs)
+        self.workers = {}       # pid -> (item, read end of its exit pipe)
+        self.host_counts = {}   # host -> number of running jobs
+        self.deferred = deque() # items waiting on a busy host
+        self.adopted = {}       # job id -> pid, of an earlier daemon's worker
+
+    def read_item(self,lane,qfile):
+        "Pulls an item from a lane of the queue.  Returns None if it has gone."
+
         # Get the contents of the oldest file.
-        oldest = qfile_list[0]
-        oldest_time = os.stat(local_queue_dir + '/' + oldest).st_mtime
-        for qf in qfile_list[1:]:
-            qf_time = os.stat(local_queue_dir + '/' + qf).st_mtime
-            if qf_time < oldest_time:
-                oldest = qf
-                oldest_time = qf_time
-        oldest_fd = open(local_queue_dir + '/' + oldest,'r')
+        oldest = qfile
+        queue_path = jsonrpc_queue.lane_dir(lane) + '/' + oldest
+        try:
+            oldest_fd = open(queue_path,'r')
+        except IOError:
+            return None  # Removed by hand since the last queue listing.
         request_str = oldest_fd.read()
         oldest_fd.close()
+
+        # Anything that isn't a complete item goes to the dead letters
+        # rather than to a worker.
+        try:
+            full_request = json.loads(request_str)
+        except ValueError:
+            jsonrpc_queue.dead_letter(queue_path, 'not valid JSON.')
+            self.job_finished({'name': oldest})
+            return None
+        if (not isinstance(full_request, dict) or
+                not isinstance(full_request.get('tmpdir'), basestring) or
+                'request' not in full_request):
+            jsonrpc_queue.dead_letter(queue_path, 'no tmpdir or request.')
+            self.job_finished({'name': oldest})
+            return None
+
+        # The file stays until the job starts (see start_worker), so a job
+        # held back on a busy host isn't lost if the daemon stops.
+        hosts = {}
+        for host in request_hosts(full_request['request']):
+            hosts[host.lower()] = 1
+        return {'name': oldest, 'lane': lane, 'request_str': request_str,
+                'full_request': full_request, 'hosts': hosts.keys(),
+                'queue_path': queue_path}
+
+    def host_limit(self, host):
+        return host_limits.get(host, max_per_host)
+
+    def can_start(self, item):
+        "True if none of the item's hosts is at its limit."
+        for host in item['hosts']:
+            limit = self.host_limit(host)
+            if limit is not None and self.host_counts.get(host, 0) >= limit:
+                return False
+        return True
+
+    def start_worker(self, item):
+        "Forks a worker process for the item."
         ## remove the file before doing anything to make sure failures
         ## don't result in runaway executions.
-        os.remove(local_queue_dir + '/' + oldest)
-      
+        try:
+            os.remove(item['queue_path'])
+        except OSError:
+            return  # Removed by hand while it was deferred.
+        # The worker holds the write end of this pipe until it exits, which
+        # is what wakes the main loop up to start the next job.
+        exit_r, exit_w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                try:
+                    # Its own process group, so that anything it leaves
+                    # running (curl) can be killed with it.
+                    os.setpgid(0, 0)
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    os.close(exit_r)
+                    self.notifier.close_in_child()
+                    self.run_an_item(item)
+                except Exception:
+                    pass
+            finally:
+                os._exit(0)
+        os.close(exit_w)
+        self.workers[pid] = (item, exit_r)
+        for host in item['hosts']:
+            self.host_counts[host] = self.host_counts.get(host, 0) + 1
+
+    def reap_workers(self):
+        "Cleans up after workers that have finished."
+        for pid in self.workers.keys():
+            try:
+                done = os.waitpid(pid, os.WNOHANG)[0]
+            except OSError:
+                done = pid
+            if not done:
+                continue
+            item, exit_r = self.workers.pop(pid)
+            os.close(exit_r)
+            kill_job_processes(pid)
+            for host in item['hosts']:
+                self.host_counts[host] -= 1
+                if not self.host_counts[host]:
+                    del self.host_counts[host]
+            self.job_finished(item)
+
+    def job_finished(self, item,
+            reason='Worker exited before the job finished.'):
+        """Closes out the job's status and sends its callback, if it has one.
+        A job that didn't finish is requeued if it can be, for reason."""
+        job_id = item['name']
+        status = jsonrpc_queue.read_status(job_id)
+        if status is None:
+            return
+        if status.get('state') not in ('done', 'failed'):
+            if self.requeue(status, reason):
+                return
+            status = jsonrpc_queue.write_status(job_id, state='failed',
+                    finished_at=time.time(), error=reason)
+        if status.get('callback'):
+            self.notifier.post(job_id, status['callback'], status)
+
+    def requeue(self, status, reason):
+        """Puts an interrupted job back in the queue, to resume.  False if
+        it can't be (no saved request, or resumed too often already)."""
+        resumes = status.get('resumes', 0)
+        if resumes >= max_resumes or not status.get('tmpdir'):
+            return False
+        try:
+            f = open(status['tmpdir'] + '/_request')
+            try:
+                async_item = json.loads(f.read())
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return False
+        async_item['resume'] = True
+        job_id = status['job_id']
+        jsonrpc_queue.enqueue(async_item,
+                status.get('lane', jsonrpc_queue.default_lane), job_id=job_id)
+        jsonrpc_queue.write_status(job_id, resumes=resumes + 1,
+                resume_reason=reason)
+        return True
+
+    def resume_interrupted(self):
+        """Closes out the jobs the daemon lost track of when it last stopped:
+        the ones that were running, and queued ones whose queue file has
+        gone.  They are requeued to resume, or marked failed.  Called once
+        at startup, after the deferred items are back in their lanes."""
+        try:
+            names = os.listdir(jsonrpc_queue.status_dir)
+        except OSError:
+            return
+        for job_id in names:
+            if job_id[0] == '.':
+                continue
+            status = jsonrpc_queue.read_status(job_id)
+            if status is None:
+                continue
+            if status.get('state') == 'running':
+                pid = status.get('pid')
+                try:
+                    os.kill(pid, 0)
+                    # Still going (or the pid has been reused), so it is
+                    # watched until it exits.
+                    self.adopted[job_id] = pid
+                    continue
+                except OSError, e:
+                    if e.errno != errno.ESRCH:
+                        continue
+                    # Its curl may still be writing the files the rerun
+                    # would carry on with.
+                    kill_job_processes(pid)
+                except TypeError:
+                    pass    # No pid recorded.
+            elif status.get('state') == 'queued':
+                if status.get('updated_at', 0) > time.time() - lost_job_grace:
+                    continue
+                try:
+                    queue_path = jsonrpc_queue.lane_dir(status.get('lane',
+                            jsonrpc_queue.default_lane)) + '/' + job_id
+                except ValueError:
+                    queue_path = None
+                if queue_path is not None and os.access(queue_path, os.F_OK):
+                    continue    # Still waiting its turn.
+            else:
+                continue
+            self.job_finished({'name': job_id},
+                    'Interrupted by a daemon restart.')
+
+    def reap_adopted(self):
+        """Closes out the jobs of an earlier daemon's workers once they have
+        exited, as reap_workers does for this daemon's own."""
+        for job_id, pid in self.adopted.items():
+            try:
+                os.kill(pid, 0)
+                continue
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    continue
+            del self.adopted[job_id]
+            kill_job_processes(pid)
+            self.job_finished({'name': job_id},
+                    'Interrupted by a daemon restart.')
+
+    def shutdown(self, signum, frame):
+        """SIGTERM handler.  Takes the workers and their curls down and
+        requeues their jobs before exiting, rather than leaving them running
+        with nobody to close them out."""
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for pid in self.workers.keys():
+            kill_job_processes(pid)
+        for pid in self.workers.keys():
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            item, exit_r = self.workers.pop(pid)
+            self.job_finished(item, 'Interrupted by a daemon shutdown.')
+        sys.exit(0)
+
+    def start_deferred(self):
+        "Starts waiting items whose hosts have freed up, oldest first."
+        still_waiting = deque()
+        while self.deferred:
+            item = self.deferred.popleft()
+            if len(self.workers) < max_workers and self.can_start(item):
+                self.start_worker(item)
+            else:
+                still_waiting.append(item)
+        self.deferred = still_waiting
+
+    def run_an_item(self,item):
+        "Sends an item to the rpc_service.  Runs in the worker process."
+        request_str = item['request_str']
+        job_id = item['name']
+        started = time.time()
+        jsonrpc_queue.write_status(job_id, state='running',
+                started_at=started, pid=os.getpid())
+
         ## Execute the request.
         try: 
-            full_request = json.loads(request_str)
+            full_request = item['full_request']
             # Go to the tmpdir from the request.
             tmpdir = full_request['tmpdir']
             os.chdir(tmpdir)
-            # _request is a copy of the original request for debugging.
+            # Journal the curl calls, so the job can resume if it is cut off.
+            jsonrpc_procs.curl_journal = tmpdir + '/_journal'
+            jsonrpc_procs.resuming = bool(full_request.get('resume'))
+            # _request is a copy of the original request, for debugging and
+            # for resuming the job if it is interrupted.
             td = open(tmpdir + '/' + '_request','w')
             td.write(request_str)
             td.close()
-            # Funally pass the request to the rpc service.
-            rpc_request_str = json.dumps(full_request['request'])
-            result = rpc_service.call(rpc_request_str)
+            # Funally pass the request to the rpc service.  It is already
+            # parsed, so it goes in as it is.
+            response = rpc_service.call_py(full_request['request'])
+            result = rpc_service.encode(response)
         except Exception:
-            time.sleep(60)
-            pass
+            jsonrpc_queue.write_status(job_id, state='failed',
+                    finished_at=time.time(), elapsed=time.time() - started,
+                    error=traceback.format_exc())
+            return
+
+        self.record_result(job_id, tmpdir, result, response, started)
+
+    def record_result(self, job_id, tmpdir, result, response, started):
+        """Saves the job's response in tmpdir/_result and in its status.
+        result is the response encoded, as written to _result."""
+        result_file = tmpdir + '/_result'
+        rf = open(result_file,'w')
+        rf.write(str(result))
+        rf.close()
+
+        status = {'state': 'done', 'finished_at': time.time(),
+                'elapsed': time.time() - started, 'result_file': result_file}
+        # response is None for a notification.
+        if isinstance(response, dict) and response.get('error'):
+            status['state'] = 'failed'
+            status['error_code'] = response['error'].get('code')
+        if result is not None and len(result) <= jsonrpc_queue.inline_result_max:
+            status['result'] = response
+        jsonrpc_queue.write_status(job_id, **status)
 
     def run(self):
-        "Loop forever function. Sleeps one second between queue checks."
-        cleanup_count = 0
+        """Loop forever function. Sleeps until jsonrpc_handler pokes the
+        wakeup pipe, a worker finishes, or for poll_interval seconds if
+        nothing happens."""
+        # First, while this process still has no threads to fork with.
+        self.notifier = NotifierProcess()
+        self.notifier.start()
+        waiter = jsonrpc_queue.QueueWaiter()
+        lanes = jsonrpc_queue.LaneScheduler()
+        collector = TmpdirCollector([jsonrpc_tmpdir, jsonrpc_tmpdir + '/.spool',
+                jsonrpc_queue.status_dir, jsonrpc_queue.dead_letter_dir],
+                in_use=jsonrpc_queue.active_paths)
+        jsonrpc_queue.restore_deferred()
+        signal.signal(signal.SIGTERM, self.shutdown)
+        self.resume_interrupted()
         while True:
 
-            if not cleanup_count:
-                self.do_cleanup()
-            cleanup_count = (cleanup_count + 1) % 3600 
-                            ## cleanup about once an hour
+            ## A little of the cleanup at a time.
+            wait = min(jsonrpc_queue.poll_interval,
+                    max(collector.step(), 0))
+
+            self.reap_workers()
+            self.reap_adopted()
+            self.start_deferred()
 
-            ## Wait until there is a file in the local_queue_dir
-            qfile_list = os.listdir(local_queue_dir)
-            if len(qfile_list) == 0:
-                time.sleep(1)
+            exit_fds = [w[1] for w in self.workers.values()]
+            if (len(self.workers) >= max_workers or
+                    len(self.deferred) >= max_deferred):
+                waiter.wait(wait, exit_fds)
+                lanes.invalidate()
                 continue
-            self.run_an_item(qfile_list)
+
+            ## Wait until there is a file in one of the queue lanes.  Lanes
+            ## found empty are only listed again after a poke (or the
+            ## poll_interval timeout), not on every pick.
+            if waiter.poked():
+                lanes.invalidate()
+            lane, qfile = lanes.pop()
+            if qfile is None:
+                waiter.wait(wait, exit_fds)
+                lanes.invalidate()
+                continue
+            item = self.read_item(lane, qfile)
+            if item is None:
+                continue
+            if self.can_start(item):
+                self.start_worker(item)
+            else:
+                item['queue_path'] = jsonrpc_queue.defer(lane, qfile)
+                self.deferred.append(item)
+
+
+def request_hosts(request):
+    """The hosts of the URLs anywhere in a JSON-RPC request (the parsed
+    object).  Only the request: the queue item's callback URL isn't a host
+    the job talks to."""
+    if isinstance(request, basestring):
+        return url_host_re.findall(request)
+    hosts = []
+    if isinstance(request, dict):
+        request = request.values()
+    if isinstance(request, list):
+        for value in request:
+            hosts.extend(request_hosts(value))
+    return hosts
+
+
+def kill_job_processes(pid):
+    """Kills whatever is left of the process group of the worker pid, e.g.
+    a curl that outlived it."""
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass    # ESRCH: nothing left.
 
 
-    def do_cleanup(self):
-        "Cleans out any directories that are older than a day."
-        tmpdir_list = os.listdir(jsonrpc_tmpdir)
-        for d in tmpdir_list:
-            dpath = jsonrpc_tmpdir + '/' + d
-            mtime = os.stat(dpath).st_mtime
-            if mtime + 86400 < time.time(): #older than a day
-                try:
-                    try:
-                        shutil.rmtree(dpath)
-                    except Exception:
-                        os.remove(dpath);
-                except Exception:
-                    pass
-    
-        
 def usage():
     print "usage: %s start|stop|restart" % sys.argv[0]
     sys.exit(2)
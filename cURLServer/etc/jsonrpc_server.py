@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2010 John McLaughlin -- Mass Animation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import sys, os, signal, errno, socket, struct
+import BaseHTTPServer
+from daemon import Daemon
+from jsonrpc_handler import handle_request, get_rpc_service, error_response
+import traceback
+
+# A long running alternative to /var/www/cgi-bin/jsonrpc.py.  The parent
+# process imports everything and sets up the rpc_service once, opens the
+# listening socket, and then forks a fixed number of workers which all
+# accept() on that socket.  Each worker handles one request at a time, so
+# the os.chdir() into each request's tmpdir can't step on another request.
+# The parent just restarts any worker that dies.
+#
+# The URL path is ignored, so http://<host>:8080/cgi-bin/jsonrpc.py?... takes
+# exactly the same query options as the CGI.
+
+server_address = ('', 8080)
+server_workers = 8
+
+
+class JSONRPCRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    "Translates the HTTP request to a CGI style environment for the handler."
+
+    def do_POST(self):
+        environ = {
+            'REQUEST_METHOD': self.command,
+            'QUERY_STRING': '',
+            'CONTENT_TYPE': self.headers.get('content-type', ''),
+            'CONTENT_LENGTH': self.headers.get('content-length', ''),
+            'REMOTE_ADDR': self.client_address[0],
+            'SERVER_NAME': self.server.server_name,
+            'SERVER_PORT': str(self.server.server_port),
+            }
+        if '?' in self.path:
+            environ['QUERY_STRING'] = self.path.split('?',1)[1]
+        for k in self.headers.keys():
+            environ['HTTP_' + k.upper().replace('-','_')] = self.headers[k]
+
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain')
+        self.end_headers()
+        sent = 0
+        try:
+            for chunk in handle_request(environ, self.rfile, get_rpc_service()):
+                self.wfile.write(chunk)
+                sent = 1
+        except Exception:
+            if sent:
+                # Part of a streamed body has gone out, so nothing more may
+                # be written after it.  Reset the connection: the client
+                # sees an error rather than a short body that ended normally.
+                self.abort_connection()
+                return
+            self.wfile.write(error_response(-32000, 'Server error',
+                    traceback.format_exc()))
+
+    def abort_connection(self):
+        "Drops the connection with a reset instead of a normal close."
+        self.close_connection = 1
+        try:
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                    struct.pack('ii', 1, 0))
+        except socket.error:
+            pass
+        # Close it here, before the server's own shutdown sends a FIN.
+        self.wfile.close()
+        self.rfile.close()
+        self.connection.close()
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        "Request logging goes to the daemon's stderr file."
+        sys.stderr.write("%s [%s] %s\n" % (self.client_address[0],
+                self.log_date_time_string(), format % args))
+
+
+class PreForkHTTPServer(BaseHTTPServer.HTTPServer):
+    "HTTPServer whose listening socket is shared by forked workers."
+
+    allow_reuse_address = True
+
+    def serve_prefork(self, workers):
+        "Keeps workers children running serve_forever() on this socket."
+        children = {}
+        while True:
+            while len(children) < workers:
+                pid = os.fork()
+                if pid == 0:
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    try:
+                        self.serve_forever()
+                    finally:
+                        os._exit(0)
+                children[pid] = 1
+            try:
+                pid, status = os.wait()
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid in children:
+                del children[pid]
+
+
+class JSONRPCServerDaemon(Daemon):
+    "Daemon class for the pre-forked JSON RPC HTTP server."
+
+    def run(self):
+        # Warm everything up before forking so the workers share it.
+        get_rpc_service()
+        httpd = PreForkHTTPServer(server_address, JSONRPCRequestHandler)
+        children_pgid = os.getpgrp()
+        def shutdown(signum, frame):
+            # Take the workers down with us.
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            os.killpg(children_pgid, signal.SIGTERM)
+            sys.exit(0)
+        signal.signal(signal.SIGTERM, shutdown)
+        httpd.serve_prefork(server_workers)
+
+
+debug = 1
+
+if __name__ == "__main__":
+
+    # Run as the "apache" user. This should prevent most mischief.
+    os.seteuid(48)
+    if debug:
+        open('/tmp/jsonrpc_server_stderr','w').close()
+        open('/tmp/jsonrpc_server_stdout','w').close()
+        daemon = JSONRPCServerDaemon('/tmp/jsonrpc_server.pid',
+                stderr='/tmp/jsonrpc_server_stderr',
+                stdout='/tmp/jsonrpc_server_stdout')
+    else:
+        daemon = JSONRPCServerDaemon('/tmp/jsonrpc_server.pid')
+    if len(sys.argv) >= 2:
+        if 'start' == sys.argv[1]:
+            daemon.start()
+        elif 'stop' == sys.argv[1]:
+            daemon.stop()
+        elif 'restart' == sys.argv[1]:
+            daemon.restart()
+        else:
+            print "Unknown command"
+            sys.exit(2)
+        sys.exit(0)
+    else:
+        print "usage: %s start|stop|restart" % sys.argv[0]
+        sys.exit(2)
@@ -0,0 +1,386 @@
+#! /usr/bin/python
+
+# Copyright (c) 2010 John McLaughlin -- Mass Animation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Shared on-disk cache for downloads made with the "curl" method.
+#
+# Jobs keep fetching the same S3 objects and public URLs into their own
+# tmpdirs.  When the cache is turned on (curl_cache_dir in jsonrpc_procs.py)
+# a simple GET to a file, e.g.
+#
+#    ["-s", "-L", "-o", "data.bin", "http://bucket.s3.amazonaws.com/data.bin"]
+#
+# is looked up here first.  The key is the sha1 of the URL and the request
+# headers given with -H.  A fresh hit is hard linked into the tmpdir (copied
+# if the tmpdir is on another file system) instead of being downloaded again.
+#
+# Freshness follows the response's Cache-Control (max-age, s-maxage,
+# no-cache, no-store) and Expires headers, or failing those, a tenth of the
+# time since Last-Modified, at most a day.  A response with only an ETag is
+# kept, but is stale straight away.
+#
+# The ETag and Last-Modified of every entry are kept in its .meta record.  A
+# stale entry isn't thrown away: the next fetch sends them back as
+# If-None-Match and If-Modified-Since, and if the server answers 304 Not
+# Modified the cached copy is used again (and is fresh for as long as the 304
+# says), so periodic re-syncs only transfer what actually changed.  A request
+# sent with "Cache-Control: no-cache" always revalidates, one with
+# "no-store" (or its own If-None-Match, If-Modified-Since or Range) bypasses
+# the cache.
+#
+# The cached files are shared by all the jobs that link them, so they are
+# read only (0444).  A job can delete or replace its link, but not write
+# into it, so anything about to write a file that may be one of these links
+# (curl's -o, cat's output, ...) calls release_link() on it first.
+#
+# When the total size of the cache goes over max_bytes, the entries used
+# longest ago are dropped until it fits.
+
+import os
+import time
+import errno
+import shutil
+import rfc822
+import sha
+import thread
+import jsonrpc_codec as json
+
+# Longest heuristic freshness for responses with only a Last-Modified.
+max_heuristic_age = 86400
+
+
+def cache_key(url, headers):
+    "The cache key for a URL and the list of request header lines."
+    h = sha.new(url)
+    lines = []
+    for line in headers:
+        name, value = (line.split(':', 1) + [''])[:2]
+        lines.append(name.strip().lower() + ':' + value.strip())
+    lines.sort()
+    for line in lines:
+        h.update('\n' + line)
+    return h.hexdigest()
+
+
+def parse_date(value):
+    "Seconds since the epoch for an HTTP date, or None."
+    if not value:
+        return None
+    t = rfc822.parsedate_tz(value)
+    if t is None:
+        return None
+    try:
+        return rfc822.mktime_tz(t)
+    except (OverflowError, ValueError):
+        return None
+
+
+def cache_control(value):
+    "Dictionary of the directives of a Cache-Control header."
+    directives = {}
+    for part in (value or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        name, arg = (part.split('=', 1) + [None])[:2]
+        if arg is not None:
+            arg = arg.strip().strip('"')
+        directives[name.strip().lower()] = arg
+    return directives
+
+
+def read_response_headers(path):
+    """Status and headers of the last response in a curl -D file.  With -L
+    there is one block per redirect."""
+    f = open(path)
+    try:
+        return parse_response_headers(f.read())
+    finally:
+        f.close()
+
+
+def parse_response_headers(text):
+    "Status and headers of the last response in curl's header output."
+    status = None
+    headers = {}
+    for line in text.split('\n'):
+        line = line.rstrip('\r')
+        if line.startswith('HTTP/'):
+            parts = line.split()
+            try:
+                status = int(parts[1])
+            except (IndexError, ValueError):
+                status = None
+            headers = {}
+        elif ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    return status, headers
+
+
+def freshness(headers, now):
+    """How long (seconds) a response may be used without checking back, or
+    None if it mustn't be stored at all."""
+    cc = cache_control(headers.get('cache-control'))
+    if 'no-store' in cc or headers.get('vary', '').strip() == '*':
+        return None
+    has_validator = 'etag' in headers or 'last-modified' in headers
+    if 'no-cache' in cc:
+        if has_validator:
+            return 0
+        return None
+    date = parse_date(headers.get('date')) or now
+    try:
+        age = max(0, int(headers.get('age', 0)))
+    except ValueError:
+        age = 0
+    for name in ('s-maxage', 'max-age'):
+        if cc.get(name) is not None:
+            try:
+                return max(0, int(cc[name]) - age)
+            except ValueError:
+                return 0
+    expires = headers.get('expires')
+    if expires is not None:
+        expires = parse_date(expires)
+        if expires is None:
+            return 0    # An invalid Expires means already expired.
+        return max(0, expires - date - age)
+    last_modified = parse_date(headers.get('last-modified'))
+    if last_modified is not None:
+        return max(0, min((date - last_modified) / 10, max_heuristic_age) - age)
+    if has_validator:
+        return 0
+    return None
+
+
+def release_link(path):
+    """If path is a read only link to a cached file, removes it, so that it
+    can be written without touching the cache."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    if not st.st_mode & 0200 and st.st_nlink > 1:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class DownloadCache(object):
+    "A directory of downloaded files, each with a .meta record."
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.access(cache_dir, os.F_OK):
+            os.makedirs(cache_dir)
+
+    def fetch(self, url, headers, output, flags, run_curl):
+        """Puts the document at url in the file output, from the cache if
+        possible.  headers are the -H header lines and flags any other curl
+        options.  run_curl(args) runs curl with the headers added and
+        returns its stdout."""
+        key = cache_key(url, headers)
+        data_path = self.cache_dir + '/' + key
+        request_cc = {}
+        for line in headers:
+            name = line.split(':', 1)[0].strip().lower()
+            if name == 'cache-control':
+                request_cc.update(cache_control(line.split(':', 1)[1]))
+            elif name in ('if-none-match', 'if-modified-since', 'range'):
+                # The caller is doing its own revalidation or asking for
+                # part of the document.
+                request_cc['no-store'] = None
+        if 'no-store' in request_cc:
+            return self.bypass(url, output, flags, run_curl)
+
+        meta = self.lookup(key)
+        if meta is not None and 'no-cache' not in request_cc:
+            if time.time() < meta['expires']:
+                if self.deliver(data_path, output):
+                    return ''
+                meta = None
+
+        # A stale entry is revalidated: the server answers 304 if the
+        # cached copy is still good, without sending it again.
+        validators = []
+        if meta is not None:
+            if meta.get('etag'):
+                validators += ['-H', 'If-None-Match: ' + meta['etag']]
+            if meta.get('last_modified'):
+                validators += ['-H', 'If-Modified-Since: ' +
+                        meta['last_modified']]
+
+        tmp_base = self.tmp_name(key)
+        tmp_path, header_path = tmp_base, tmp_base + '.headers'
+        try:
+            stdout = run_curl(validators + flags +
+                    ['-D', header_path, '-o', tmp_path, url])
+            now = time.time()
+            try:
+                status, response_headers = read_response_headers(header_path)
+            except IOError:
+                status, response_headers = None, {}
+
+            if status == 304 and validators:
+                # Not modified.  The 304's own headers say how long the
+                # cached copy is good for now.
+                stored = {'etag': meta.get('etag'),
+                        'last-modified': meta.get('last_modified')}
+                for name in stored.keys():
+                    if stored[name] is None:
+                        del stored[name]
+                stored.update(response_headers)
+                lifetime = freshness(stored, now)
+                if lifetime is not None and self.deliver(data_path, output):
+                    meta['expires'] = now + lifetime
+                    meta['validated_at'] = now
+                    meta['etag'] = stored.get('etag')
+                    meta['last_modified'] = stored.get('last-modified')
+                    self.write_meta(key, meta)
+                    return stdout
+                # Evicted in the meantime.  Get it again.
+                return self.bypass(url, output, flags, run_curl)
+
+            if not os.access(tmp_path, os.F_OK):
+                return stdout   # e.g. -f and an HTTP error: nothing written.
+            lifetime = None
+            if status == 200:
+                lifetime = freshness(response_headers, now)
+            if lifetime is None:
+                move(tmp_path, output)
+                return stdout
+
+            os.chmod(tmp_path, 0444)
+            os.rename(tmp_path, data_path)
+            self.write_meta(key, {'url': url, 'stored_at': now,
+                    'expires': now + lifetime,
+                    'size': os.stat(data_path).st_size,
+                    'etag': response_headers.get('etag'),
+                    'last_modified': response_headers.get('last-modified')})
+            if not self.deliver(data_path, output):
+                shutil.copyfile(data_path, output)
+            self.evict()
+            return stdout
+        finally:
+            for path in (tmp_path, header_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def tmp_name(self, key):
+        """A temp file name in the cache for key, private to this thread
+        (parallel and curl_multi can fetch the same URL at once)."""
+        return '%s/.tmp-%d-%d-%s' % (self.cache_dir, os.getpid(),
+                thread.get_ident(), key)
+
+    def bypass(self, url, output, flags, run_curl):
+        "Downloads straight to output, without the cache."
+        release_link(output)
+        return run_curl(flags + ['-o', output, url])
+
+    def lookup(self, key):
+        "The entry's meta record, or None if it isn't (completely) there."
+        try:
+            f = open(self.cache_dir + '/' + key + '.meta')
+            try:
+                meta = json.loads(f.read())
+            finally:
+                f.close()
+            if os.stat(self.cache_dir + '/' + key).st_size != meta['size']:
+                return None
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        return meta
+
+    def write_meta(self, key, meta):
+        meta_path = self.cache_dir + '/' + key + '.meta'
+        tmp_path = self.tmp_name(key) + '.meta'
+        f = open(tmp_path, 'w')
+        try:
+            f.write(json.dumps(meta))
+        finally:
+            f.close()
+        os.rename(tmp_path, meta_path)
+
+    def deliver(self, data_path, output):
+        """Links a cached file to output.  False if the entry has gone in
+        the meantime."""
+        try:
+            os.remove(output)
+        except OSError:
+            pass
+        try:
+            os.link(data_path, output)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return False
+            # EXDEV and the like: the tmpdir is on another file system.
+            try:
+                shutil.copyfile(data_path, output)
+            except IOError:
+                return False
+        # The meta file's mtime is the last use, for the LRU eviction.
+        try:
+            os.utime(data_path + '.meta', None)
+        except OSError:
+            pass
+        return True
+
+    def evict(self):
+        "Drops the least recently used entries until the cache fits."
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.meta') or name[0] == '.':
+                continue
+            key = name[:-5]
+            try:
+                used = os.stat(self.cache_dir + '/' + name).st_mtime
+                size = os.stat(self.cache_dir + '/' + key).st_size
+            except OSError:
+                continue
+            entries.append((used, key, size))
+            total += size
+        entries.sort()
+        for used, key, size in entries:
+            if total <= self.max_bytes:
+                break
+            for path in (key + '.meta', key):
+                try:
+                    os.remove(self.cache_dir + '/' + path)
+                except OSError:
+                    pass
+            total -= size
+
+
+def move(src, dst):
+    "os.rename, or a copy if dst is on another file system."
+    try:
+        os.rename(src, dst)
+    except OSError, e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copyfile(src, dst)
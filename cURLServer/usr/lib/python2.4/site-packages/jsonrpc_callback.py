@@ -0,0 +1,226 @@
+#! /usr/bin/python
+
+# Copyright (c) 2010 John McLaughlin -- Mass Animation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Completion notices for async jobs queued with the callback=<url> option.
+#
+# When a job finishes the daemon POSTs the job's status record (see
+# jsonrpc_queue.py) as JSON to the callback URL.  The notice is signed the
+# same way requests to the cURL Server are, with the signature added to the
+# URL's query string:
+#
+#    h = hmac.new(hashkey, notice_body, sha)
+#    signature = base64.b64encode(h.digest())
+#
+# so the receiver can check it came from this server.  Any 2xx or 3xx
+# response counts as delivered.  Otherwise the notice is retried after
+# callback_backoff seconds, doubling each time, up to callback_retries
+# attempts.  The notices go out from callback_connections threads sharing a
+# jsonrpc_http.ConnectionPool of the same size.
+#
+# The daemon forks its workers, and a fork while another thread holds a lock
+# leaves that lock held forever in the child.  So the threads don't run in
+# the daemon: NotifierProcess forks a process of their own up front, and the
+# daemon hands it notices through a pipe.
+
+import os
+import sys
+import time
+import traceback
+import heapq
+import threading
+import urllib
+import sha, base64, hmac
+import jsonrpc_codec as json
+from jsonrpc_keys import get_hashkey
+from jsonrpc_http import ConnectionPool
+import jsonrpc_queue
+
+callback_retries = 5
+callback_backoff = 2        # seconds before the first retry
+callback_connections = 4
+
+
+def sign(body):
+    "The request signature of body, base64 encoded."
+    h = hmac.new(get_hashkey(), body, sha)
+    return base64.b64encode(h.digest())
+
+
+def signed_url(url, body):
+    "The callback url with the signature of body added to its query."
+    if '?' in url:
+        sep = '&'
+    else:
+        sep = '?'
+    return url + sep + 'signature=' + urllib.quote(sign(body))
+
+
+class CallbackNotifier(object):
+    "Delivers completion notices in background threads."
+
+    def __init__(self, workers=callback_connections):
+        self.workers = workers
+        self.pool = ConnectionPool(workers)
+        self.cond = threading.Condition()
+        self.pending = []   # heap of (due time, attempt, job_id, url, body)
+        self.sending = 0    # notices being sent right now
+
+    def start(self):
+        for n in range(self.workers):
+            t = threading.Thread(target=self._work)
+            t.setDaemon(True)
+            t.start()
+
+    def post(self, job_id, url, notice):
+        "Queues a notice (a JSON-able object) for delivery to url."
+        self._schedule(time.time(), 0, job_id, url, json.dumps(notice))
+
+    def _schedule(self, due, attempt, job_id, url, body):
+        self.cond.acquire()
+        try:
+            heapq.heappush(self.pending, (due, attempt, job_id, url, body))
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def busy(self):
+        "True while there are notices waiting or being sent."
+        self.cond.acquire()
+        try:
+            return bool(self.pending) or self.sending > 0
+        finally:
+            self.cond.release()
+
+    def _next(self):
+        "Waits for the next notice that is due and takes it off the heap."
+        self.cond.acquire()
+        try:
+            while True:
+                if self.pending:
+                    wait = self.pending[0][0] - time.time()
+                    if wait <= 0:
+                        self.sending += 1
+                        return heapq.heappop(self.pending)
+                    self.cond.wait(wait)
+                else:
+                    self.cond.wait()
+        finally:
+            self.cond.release()
+
+    def _work(self):
+        while True:
+            due, attempt, job_id, url, body = self._next()
+            try:
+                self._send(attempt + 1, job_id, url, body)
+            finally:
+                self.cond.acquire()
+                self.sending -= 1
+                self.cond.release()
+
+    def _send(self, attempt, job_id, url, body):
+        "Makes one delivery attempt, and schedules the retry if it fails."
+        try:
+            status = self.pool.request('POST', signed_url(url, body), body,
+                    {'Content-Type': 'application/json'})[0]
+            error = 'HTTP status %d' % status
+            delivered = 200 <= status < 400
+        except Exception, e:
+            error = str(e)
+            delivered = False
+
+        if delivered:
+            self._record(job_id, callback_state='delivered',
+                    callback_attempts=attempt)
+        elif attempt < callback_retries:
+            retry_at = time.time() + callback_backoff * 2 ** (attempt - 1)
+            self._schedule(retry_at, attempt, job_id, url, body)
+        else:
+            sys.stderr.write('Callback for job %s to %s failed: %s\n' %
+                    (job_id, url, error))
+            self._record(job_id, callback_state='failed',
+                    callback_attempts=attempt, callback_error=error)
+
+    def _record(self, job_id, **fields):
+        try:
+            jsonrpc_queue.write_status(job_id, **fields)
+        except Exception:
+            pass
+
+
+# Seconds the notifier process keeps going after the daemon has gone, to
+# finish the retries it still has.
+notifier_linger = callback_backoff * 2 ** callback_retries
+
+
+class NotifierProcess(object):
+    """Runs a CallbackNotifier in a child process, fed through a pipe.  Same
+    post() as CallbackNotifier.  start() must be called before the daemon
+    has any threads."""
+
+    def __init__(self, workers=callback_connections):
+        self.workers = workers
+        self.pid = None
+        self.fd = None
+
+    def start(self):
+        read_fd, self.fd = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                try:
+                    os.close(self.fd)
+                    self._serve(read_fd)
+                except Exception:
+                    traceback.print_exc()
+            finally:
+                os._exit(0)
+        os.close(read_fd)
+
+    def post(self, job_id, url, notice):
+        "Hands a notice to the notifier process."
+        data = json.dumps([job_id, url, notice]) + '\n'
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def close_in_child(self):
+        "For forked workers: only the daemon should hold the pipe open."
+        os.close(self.fd)
+
+    def _serve(self, read_fd):
+        "The notifier process: posts notices until the daemon goes away."
+        notifier = CallbackNotifier(self.workers)
+        notifier.start()
+        f = os.fdopen(read_fd)
+        while True:
+            # readline() rather than iterating, which reads ahead and would
+            # sit on a notice until more arrived.
+            line = f.readline()
+            if not line:
+                break
+            try:
+                job_id, url, notice = json.loads(line)
+            except ValueError:
+                continue
+            notifier.post(job_id, url, notice)
+        give_up = time.time() + notifier_linger
+        while notifier.busy() and time.time() < give_up:
+            time.sleep(1)
@@ -0,0 +1,120 @@
+#! /usr/bin/python
+
+# Copyright (c) 2010 John McLaughlin -- Mass Animation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# The one place the cURL Server gets its JSON encoder and decoder from.
+#
+# The modules used to import simplejson (or json) each on their own.  Now
+# they import this as "json" and get loads() and dumps() from the fastest
+# library installed, tried in the order of codec_preference:
+#
+#    cjson         python-cjson, a small C codec.
+#    speedups      simplejson, only if its C speedups are built.
+#    json          the standard library's (Python 2.6 and later).
+#    simplejson    simplejson in pure Python.
+#
+# or the one named in the JSONRPC_CODEC environment variable.  ujson isn't
+# on the list because it rounds floats to fewer digits than they have.
+#
+# The fast libraries don't fail in quite the same ways as simplejson, so
+# whenever one fails the call is made again with the reference library
+# (simplejson or json), and its answer or its exception is the one that
+# counts.  Calls with keyword arguments (indent=4 for the diagnostics) go
+# straight to the reference library.
+#
+# The other half of cutting the JSON work is in jsonrpcbase, whose call()
+# and call_py() also take a request that is already parsed, so sequence,
+# parallel and the daemon hand sub-requests over without a dumps() and
+# loads() round trip.
+
+import os
+
+codec_preference = ['cjson', 'speedups', 'json', 'simplejson']
+
+
+def _reference():
+    "The library whose behavior the others must match."
+    try:
+        import simplejson
+        return simplejson
+    except ImportError:
+        import json
+        return json
+
+def _load(name):
+    """Returns (name, dumps, loads) for one of codec_preference, or None if
+    it isn't installed."""
+    try:
+        if name == 'cjson':
+            import cjson
+            def cjson_loads(s):
+                if '\\/' in s:
+                    # Older cjson leaves the backslash in "\/".
+                    return reference.loads(s)
+                return cjson.decode(s)
+            return name, cjson.encode, cjson_loads
+        if name == 'speedups':
+            import simplejson
+            from simplejson import _speedups
+            return name, simplejson.dumps, simplejson.loads
+        if name == 'json':
+            import json
+            if not hasattr(json, 'loads'):
+                return None     # The old python-json package.
+            return name, json.dumps, json.loads
+        if name == 'simplejson':
+            import simplejson
+            return name, simplejson.dumps, simplejson.loads
+    except ImportError:
+        pass
+    return None
+
+def _pick():
+    names = codec_preference
+    if os.environ.get('JSONRPC_CODEC'):
+        names = [os.environ['JSONRPC_CODEC']] + names
+    for name in names:
+        codec = _load(name)
+        if codec is not None:
+            return codec
+    raise ImportError('No JSON library available: %s' % names)
+
+reference = _reference()
+codec_name, _dumps, _loads = _pick()
+
+
+def dumps(obj, **kw):
+    "Encodes obj as a JSON string."
+    if kw or _dumps is reference.dumps:
+        return reference.dumps(obj, **kw)
+    try:
+        return _dumps(obj)
+    except Exception:
+        return reference.dumps(obj)
+
+def loads(s):
+    "Decodes the JSON string s.  Raises ValueError if it isn't JSON."
+    if _loads is reference.loads:
+        return reference.loads(s)
+    try:
+        return _loads(s)
+    except Exception:
+        return reference.loads(s)
@@ -0,0 +1,243 @@
+#! /usr/bin/python
+
+# Copyright (c) 2010 John McLaughlin -- Mass Animation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Garbage collection of the tmpdirs, status records and other leftovers, for
+# the daemon.
+#
+# Everything under /tmp/jsonrpc is deleted a day after it was last touched.
+# Doing that in one go (listdir, stat and rmtree of tens of thousands of
+# directories) stalls the daemon's main loop for seconds, so TmpdirCollector
+# does it as a series of small steps instead.  Each step does at most
+# gc_step_ops file system operations (a stat, an unlink, an rmdir, ...) and
+# steps are at least gc_step_pause seconds apart, which caps the I/O the
+# collector can take away from the jobs.
+#
+# A pass lists each root, stats the entries into an index sorted by age, then
+# removes the ones older than gc_max_age.  A directory is first renamed to a
+# .gc- name, so it vanishes at once, and then taken apart a few files per
+# step.  Passes run every gc_interval seconds of wall clock time.
+#
+# If the file system gets short of space (less than gc_min_free of it free)
+# a pass is started straight away, and after the expired entries it goes on
+# evicting the oldest ones until gc_free_target of the file system is free.
+# Entries younger than gc_quota_min_age are never evicted, since their jobs
+# are probably still running.
+#
+# Rewriting a file deep in a tmpdir doesn't change the tmpdir's own mtime,
+# so age alone can't tell that a long job is still using it.  The daemon
+# passes in_use, which generates the tmpdirs and status files of the jobs that
+# are queued or running, and those are never removed, however old they look.
+# in_use does one file system operation per item (None for an item that isn't
+# a path), so reading the status records is spread over the steps like the
+# rest of the pass, and it is read once per pass, when first needed.
+
+import os
+import time
+
+gc_interval = 3600          # seconds between passes
+gc_max_age = 86400          # seconds
+gc_step_ops = 100
+gc_step_pause = 0.1         # seconds
+gc_space_check = 60         # seconds between free space checks
+gc_min_free = 0.10          # fraction of the file system
+gc_free_target = 0.15
+gc_quota_min_age = 600      # seconds
+
+trash_prefix = '.gc-'
+
+
+def free_fraction(path):
+    "Fraction of the file system holding path that is free for users."
+    st = os.statvfs(path)
+    if not st.f_blocks:
+        return 1.0
+    return float(st.f_bavail) / st.f_blocks
+
+
+class TmpdirCollector(object):
+    "Incremental, rate limited cleanup of a set of directories."
+
+    def __init__(self, roots, max_age=gc_max_age, step_ops=gc_step_ops,
+            in_use=None):
+        self.roots = roots
+        self.in_use = in_use
+        self.max_age = max_age
+        self.step_ops = step_ops
+        self.work = None        # generator for the pass in progress
+        self.next_pass = 0
+        self.next_space_check = 0
+        self.next_step = 0
+        self.removed = 0
+
+    def step(self):
+        """Does the next bit of work, if any is due.  Returns the number of
+        seconds until the collector next wants to run."""
+        now = time.time()
+        if self.work is None:
+            start = now >= self.next_pass
+            if not start and now >= self.next_space_check:
+                self.next_space_check = now + gc_space_check
+                start = self.short_of_space(gc_min_free)
+            if not start:
+                return min(self.next_pass, self.next_space_check) - now
+            self.next_pass = now + gc_interval
+            self.work = self._pass()
+        elif now < self.next_step:
+            return self.next_step - now
+
+        try:
+            for n in range(self.step_ops):
+                self.work.next()
+        except StopIteration:
+            self.work = None
+            return min(self.next_pass, self.next_space_check) - time.time()
+        self.next_step = time.time() + gc_step_pause
+        return gc_step_pause
+
+    def short_of_space(self, fraction):
+        "True if any root's file system has less than fraction free."
+        for root in self.roots:
+            try:
+                if free_fraction(root) < fraction:
+                    return True
+            except OSError:
+                pass
+        return False
+
+    def _pass(self):
+        "One collection pass.  Yields after every file system operation."
+        busy = None
+        for root in self.roots:
+            try:
+                names = os.listdir(root)
+            except OSError:
+                continue
+            yield None
+
+            index = []
+            for name in names:
+                path = root + '/' + name
+                if name.startswith(trash_prefix):
+                    # Left over from an interrupted pass.
+                    for x in self._remove(path):
+                        yield x
+                    continue
+                if name[0] == '.':
+                    continue
+                try:
+                    mtime = os.lstat(path).st_mtime
+                except OSError:
+                    continue
+                index.append((mtime, path))
+                yield None
+            index.sort()
+
+            now = time.time()
+            evicting = False
+            for mtime, path in index:
+                if mtime > now - self.max_age:
+                    # Everything from here on is young enough to keep,
+                    # unless the disk is filling up.
+                    if mtime > now - gc_quota_min_age:
+                        break
+                    if not evicting:
+                        evicting = self.short_of_space(gc_min_free)
+                    elif not self.short_of_space(gc_free_target):
+                        evicting = False
+                    yield None
+                    if not evicting:
+                        break
+                if busy is None:
+                    busy = []
+                    for x in self._busy(busy):
+                        yield x
+                if self._is_busy(path, busy):
+                    continue
+                for x in self._remove(path):
+                    yield x
+
+    def _busy(self, busy):
+        """Adds the paths that must be kept, from in_use, to busy.  Yields
+        after each item."""
+        if self.in_use is None:
+            return
+        try:
+            for path in self.in_use():
+                if path is not None:
+                    busy.append(path)
+                yield None
+        except (IOError, OSError):
+            return
+
+    def _is_busy(self, path, busy):
+        "True if path is, or contains, one of the busy paths."
+        for busy_path in busy:
+            if busy_path == path or busy_path.startswith(path + '/'):
+                return True
+        return False
+
+    def _remove(self, path):
+        "Removes a file or a whole directory tree, one entry at a time."
+        if not os.path.isdir(path) or os.path.islink(path):
+            try:
+                os.remove(path)
+                self.removed += 1
+            except OSError:
+                pass
+            yield None
+            return
+
+        root, name = os.path.split(path)
+        if not name.startswith(trash_prefix):
+            trash = root + '/' + trash_prefix + name
+            try:
+                os.rename(path, trash)
+            except OSError:
+                return  # Gone already.
+            path = trash
+            yield None
+
+        # Bottom up, so each directory is empty by the time it is reached.
+        for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+            for name in filenames:
+                try:
+                    os.remove(dirpath + '/' + name)
+                except OSError:
+                    pass
+                yield None
+            for name in dirnames:
+                sub = dirpath + '/' + name
+                try:
+                    if os.path.islink(sub):
+                        os.remove(sub)
+                    else:
+                        os.rmdir(sub)
+                except OSError:
+                    pass
+                yield None
+        try:
+            os.rmdir(path)
+            self.removed += 1
+        except OSError:
+            pass
+        yield None
@@ -0,0 +1,453 @@
+#! /usr/bin/python
+
+# Copyright (c) 2010 John McLaughlin -- Mass Animation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# The HTTP side of the cURL Server.  This is everything that used to live in
+# cgi-bin/jsonrpc.py, pulled out so the same code can be driven three ways:
+#
+#    cgi-bin/jsonrpc.py ..... the original one-process-per-request CGI.
+#    application() .......... a WSGI application (e.g. mod_wsgi).  Run it
+#                             with processes and one thread per process,
+#                             since every request does an os.chdir().
+#    /etc/jsonrpc_server.py . a pre-forked standalone HTTP server.
+#
+# The last two keep the interpreter, the imports, and the rpc_service warm
+# between requests, which is most of the cost of a small request.
+
+import sys
+import os
+import cgi
+import shutil
+import tempfile
+import traceback
+import jsonrpc_codec as json
+from jsonrpc_keys import get_hashkey
+import jsonrpc_queue
+from jsonrpc_procs import curl_stream, StreamError
+from jsonrpc_multipart import MultipartSpooler, MultipartError
+
+import sha, urllib, base64, hmac
+import re
+
+
+tmpdir_root = '/tmp/jsonrpc'
+
+# Uploaded files are parsed into here until the request is authenticated.
+spool_root = tmpdir_root + '/.spool'
+
+
+def handle_request(environ, input_fp, rpc_service):
+    """Processes one HTTP request and returns the response body as an
+    iterable of strings.  environ is a CGI style environment (QUERY_STRING,
+    CONTENT_TYPE, CONTENT_LENGTH, ...) and input_fp is the request body."""
+
+    out = []
+
+    # QUERY_STRING could have these options
+    #    signature  Required for any service access.  This is an hmak/sha1
+    #               hash againt the request string.
+    #    diag ..... Run "run_diagnostics"  This allows the user to get a lot
+    #               of info on what might be happening on the server.
+    #    async .... Send the request to the asynchronous queue.
+    #    tmpdir ... User explicitly sets the tmpdir for the task execution.
+    #    log ...... Logs the request, response, and environment in
+    #               tmpdir/jsonrpc.log
+    #    stream ... For a single "curl" request, send curl's output straight
+    #               back as the response body as it arrives, instead of as
+    #               a JSON-RPC result.
+    #    job_status Returns the status record of the async job with this
+    #               job id.  Cheap enough to poll.
+    #    callback . With async, a URL that gets a signed POST of the job's
+    #               status record when the job finishes.
+    #    priority . With async, the queue lane: high, normal (the default)
+    #               or bulk.
+    #    durable .. With async, the queued job is on disk (fsync) before
+    #               the response goes back.
+    option_dict = cgi.parse_qs(environ.get('QUERY_STRING', ''))
+
+
+    # Check that there is a signature.
+    if not 'signature' in option_dict:
+        out.append(json.dumps({
+            "jsonrpc": "2.0",
+            "error": {"code": -32098, "message": "No signature."},
+            "id": None}) + '\n')
+        return out
+
+    # Read the request data.
+    ctype, pdict = cgi.parse_header(environ.get('CONTENT_TYPE', ''))
+    request_str = ''
+    uploads = []
+    spool_dir = None
+    if ctype == 'multipart/form-data':
+        ## Spool the file parts, and keep the "jsonrpc" part.
+        if not os.access(spool_root, os.F_OK):
+            os.makedirs(spool_root)
+        spool_dir = tempfile.mkdtemp(dir=spool_root)
+        spooler = MultipartSpooler(input_fp, pdict.get('boundary', ''),
+                content_length(environ), spool_dir)
+        try:
+            if not pdict.get('boundary'):
+                raise MultipartError('No multipart boundary.')
+            spooler.parse()
+        except MultipartError, e:
+            shutil.rmtree(spool_dir, True)
+            out.append(error_response(-32099, 'Bad multipart data.', str(e)))
+            return out
+        request_str = spooler.fields.get('jsonrpc', '')
+        uploads = spooler.uploads
+    else:
+        form = cgi.FieldStorage(fp=input_fp, environ=environ)
+        if not form.file:
+            out.append(json.dumps({
+                "jsonrpc": "2.0",
+                "error": {"code": -32099, "message": "No post data."},
+                "id": None}) + '\n')
+            return out
+        request_str = form.file.read()
+
+    try:
+        return respond(environ, option_dict, request_str, uploads,
+                rpc_service)
+    finally:
+        # Anything still here didn't make it into a tmpdir.
+        if spool_dir is not None:
+            shutil.rmtree(spool_dir, True)
+
+
+def content_length(environ):
+    "CONTENT_LENGTH as an int, or None if the client didn't send one."
+    try:
+        return int(environ.get('CONTENT_LENGTH'))
+    except (TypeError, ValueError):
+        return None
+
+
+def respond(environ, option_dict, request_str, uploads, rpc_service):
+    """Checks the signature and runs the request.  uploads is a list of
+    (filename, spool_path) for the uploaded files."""
+
+    out = []
+
+    # See jsonrpc_keys.py for where the hashkey comes from.
+    hashkey = get_hashkey()
+    h = hmac.new(hashkey,request_str,sha)
+    target_sig = base64.b64encode(h.digest())
+
+    if target_sig != option_dict['signature'][0]:
+        data = ''
+        # data += '~'+hashkey+'~'+request_str+'~'+target_sig+'~'+str(option_dict['signature'][0])+'~'
+        out.append(json.dumps({
+            "jsonrpc": "2.0",
+            "error": {
+                "code": -32097,
+                "message": "Invalid Signature.",
+                "data": data
+                },
+            "id": None}) + '\n')
+        return out
+
+    # status of an async job
+    if 'job_status' in option_dict:
+        try:
+            status = jsonrpc_queue.read_status(option_dict['job_status'][0])
+        except ValueError:
+            status = None
+        if status is None:
+            out.append(error_response(-32096, 'No such job.'))
+        else:
+            out.append(json.dumps({
+                "jsonrpc": "2.0",
+                "result": status,
+                "id": None
+                }) + '\n')
+        return out
+
+    # output all diagnostic data
+    if 'diag' in option_dict and option_dict['diag'][0]:
+        diag_info = diagnostic_data(option_dict)
+        out.append(json.dumps(diag_info, indent=4) + '\n')
+        return out
+
+    # Establish a tmpdir location.
+    # A user specified a tmpdir then is relative to tht tmpdir_root.
+    # Otherwise it is named by the job id, which unlike the pid is never
+    # reused.  All diretories are created as needed.
+    job_id = jsonrpc_queue.new_job_id()
+    if 'tmpdir' in option_dict:
+        tmpdir = tmpdir_root + '/' + option_dict['tmpdir'][0]
+    else:
+        tmpdir = tmpdir_root + '/' + job_id
+    if not os.access(tmpdir,os.F_OK):
+        os.makedirs(tmpdir)
+    os.chdir(tmpdir)
+
+    # Now handle file uploads if necessary.  They are already on disk, on
+    # the same file system, so this is only a rename.
+    for filename, spool_path in uploads:
+        os.rename(spool_path, tmpdir + '/' + filename)
+
+    result = ''
+    if 'async' in option_dict and option_dict['async'][0]:
+        ## Item to be put in the async queue.  Currently just need a tmpdir
+        ## and the request.
+        async_item = {
+                'tmpdir': tmpdir,
+                'request': json.loads(request_str)
+                }
+        if 'callback' in option_dict:
+            callback = option_dict['callback'][0]
+            if not re.match(r'^https?://', callback):
+                out.append(error_response(-32602,
+                        'callback must be an http or https URL.'))
+                return out
+            async_item['callback'] = callback
+        lane = option_dict.get('priority', [jsonrpc_queue.default_lane])[0]
+        try:
+            jsonrpc_queue.lane_dir(lane)
+        except ValueError:
+            out.append(error_response(-32602,
+                    'priority must be one of: ' + ', '.join(
+                    [name for name, weight in jsonrpc_queue.queue_lanes])))
+            return out
+        durable = None
+        if 'durable' in option_dict:
+            durable = option_dict['durable'][0] not in ('', '0')
+        queue_path = jsonrpc_queue.enqueue(async_item, lane, durable, job_id)
+
+        queued = {'queue_path': queue_path, 'job_id': job_id}
+        result = json.dumps(queued)
+        out.append(json.dumps({
+            "jsonrpc": "2.0",
+            "result": queued,
+            "id": None
+            }) + '\n')
+    elif 'stream' in option_dict and option_dict['stream'][0]:
+        try:
+            rdata = json.loads(request_str)
+        except ValueError:
+            rdata = None
+        if (not isinstance(rdata, dict) or rdata.get('method') != 'curl' or
+                not isinstance(rdata.get('params', []), list)):
+            out.append(error_response(-32600,
+                    'stream=1 only supports a single "curl" request.'))
+            return out
+        return stream_response(rdata.get('params', []), option_dict,
+                request_str, environ, tmpdir)
+    else:
+        # synchronous execution.
+        result = rpc_service.call(request_str)
+        out.append(str(result) + '\n')
+
+    if 'log' in option_dict and option_dict['log'][0]:
+        write_log(tmpdir, request_str, result, environ)
+
+    return out
+
+
+def stream_response(params, option_dict, request_str, environ, tmpdir):
+    """Generator for the stream=1 response body.  A failed transfer is
+    logged and the exception passed on, which aborts the response."""
+    nbytes = 0
+    logged = {'streamed_bytes': 0, 'exit_code': 0}
+    try:
+        for chunk in curl_stream(*params):
+            nbytes += len(chunk)
+            yield chunk
+    except StreamError, e:
+        logged['exit_code'] = e.exit_code
+        logged['error'] = e.stderr
+    logged['streamed_bytes'] = nbytes
+    if 'log' in option_dict and option_dict['log'][0]:
+        write_log(tmpdir, request_str, logged, environ)
+    if logged['exit_code']:
+        raise StreamError(logged['exit_code'], logged.get('error', ''))
+
+
+def write_log(tmpdir, request_str, result, environ):
+    "Logs request, response, and environment to tmpdir/jsonrpc.log"
+    log_fd = open(tmpdir + '/jsonrpc.log','w')
+    log_fd.write('{"Request":' + request_str + ', ')
+    log_fd.write('"Result":' + json.dumps(result) + ', ')
+
+    log_fd.write('"Environment": [')
+    env_keys = sorted(environ.keys())
+    env_out = ''
+    for k in env_keys:
+        if not isinstance(environ[k], basestring):
+            continue    # WSGI puts file objects etc. in environ.
+        env_out += '["'+k+'"' + ', '+ json.dumps(environ[k]) + '], '
+
+    log_fd.write(env_out[:-2]+']}')
+    log_fd.close()
+
+
+def diagnostic_data(option_dict):
+    "Dump of everything relevant to the tasks and queue."
+    diag = {
+            'jsonrpc.log': {
+                'info': 'This contains the request, result, and linux environment of the request.',
+                'data': None
+                },
+            'tmpdir_list': {
+                'info': 'Directory listing of the tmpdir.',
+                'data':[]
+                },
+            'tmpdir': {
+                'info': 'tmpdir path',
+                'data': None
+                },
+            'daemon_running': {
+                'info': 'Is the daemon running for the async queue?',
+                'data': False
+                },
+            'queue_list': {
+                'info': 'Listing of the queued tasks.  Normally this is empty.',
+                'data': None
+                },
+            'queue_request': {
+                'info': 'Request passed to async jsonrpc daemon.',
+                'data': None
+                },
+            'queue_stderr': {
+                'info': 'Daemon crash data.',
+                'data': None
+                },
+            'queue_stdout': {
+                'info': 'This generally only contains data when the daemon crashes.',
+                'data': None
+                }
+            }
+    prev_pid = ''
+    if 'tmpdir' in option_dict:
+        if option_dict['tmpdir'][0][0] == '/':
+            tmpdir = option_dict['tmpdir'][0]
+        else:
+            prev_pid = option_dict['tmpdir'][0]
+            tmpdir = tmpdir_root+ '/' + option_dict['tmpdir'][0]
+    else:
+        tmpdir_list = [d for d in os.listdir(tmpdir_root) if d[0] != '.']
+        if tmpdir_list:
+            newest = tmpdir_list[0]
+            newest_time = os.stat(tmpdir_root + '/' + newest).st_mtime
+            for d in tmpdir_list[1:]:
+                d_time = os.stat(tmpdir_root + '/' + d).st_mtime
+                if d_time > newest_time:
+                    newest = d
+                    newest_time = d_time
+            tmpdir = tmpdir_root + '/' + newest
+            prev_pid = newest
+
+    os.chdir(tmpdir)
+
+    diag['tmpdir']['data'] = tmpdir
+    try:
+        log_contents = open('jsonrpc.log').read()
+        log_json = ''
+        try:
+            log_json = json.loads(log_contents)
+            diag['jsonrpc.log']['data'] = log_json
+        except Exception:
+            diag['jsonrpc.log']['data'] = log_contents
+            #raise
+    except Exception:
+        #raise
+        pass
+
+    try:
+        diag['tmpdir_list']['data'] = os.listdir(tmpdir)
+    except Exception:
+        pass
+
+    try:
+        req_file = tmpdir + '/_request'
+        if os.access(req_file,os.F_OK):
+            request_str = open(req_file).read()
+            try:
+                diag['queue_request']['data'] = json.loads(request_str)
+            except Exception:
+                diag['queue_request']['data'] = request_str
+    except Exception:
+        pass
+
+    try:
+        pid_file = '/tmp/jsonrpc_daemon.pid'
+        if os.access(pid_file,os.F_OK):
+            pid = open(pid_file).read().strip()
+            diag['daemon_running']['data'] = os.access('/proc/'+pid,os.F_OK)
+    except Exception:
+        pass
+    queue_list = []
+    for lane, weight in jsonrpc_queue.queue_lanes:
+        queue_dir = jsonrpc_queue.lane_dir(lane)
+        try:
+            queue_file_list = os.listdir(queue_dir)
+        except Exception:
+            continue
+        for file in queue_file_list:
+            item = {'task_id': file, 'lane': lane}
+            try:
+                item['task'] = open(queue_dir + '/' + file).read()
+            except Exception:
+                pass
+            queue_list.append(item)
+    diag['queue_list']['data'] = queue_list
+    try:
+        diag['jsonrpc_stderr']['data'] = open('/tmp/jsonrpc_stderr').read()
+    except Exception:
+        pass
+    try:
+        diag['jsonrpc_stdout']['data'] = open('/tmp/jsonrpc_stdout').read()
+    except Exception:
+        pass
+    return diag
+
+
+def error_response(code, message, data=None):
+    "A JSON-RPC error response for failures outside of the rpc_service."
+    return json.dumps({
+        "jsonrpc": "2.0",
+        "error": {"code": code, "message": message, "data": data},
+        "id": None}) + '\n'
+
+
+# The rpc_service for the long running modes is set up once per process.
+_rpc_service = None
+
+def get_rpc_service():
+    "Returns this process's rpc_service, setting it up on first use."
+    global _rpc_service
+    if _rpc_service is None:
+        from jsonrpc_procs import rpc_service_setup
+        _rpc_service = rpc_service_setup()
+    return _rpc_service
+
+
+def application(environ, start_response):
+    "WSGI entry point.  Same query options and responses as the CGI."
+    try:
+        body = handle_request(environ, environ['wsgi.input'],
+                get_rpc_service())
+    except Exception:
+        body = [error_response(-32000, 'Server error',
+                traceback.format_exc())]
+    start_response('200 OK', [('Content-type', 'text/plain')])
+    return body
@@ -0,0 +1,151 @@
+#! /usr/bin/python
+
+# Copyright (c) 2010 John McLaughlin -- Mass Animation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Small HTTP client helpers for the requests the server makes itself (as
+# opposed to the ones it makes by running curl).
+#
+# ConnectionPool keeps connections open between requests to the same host,
+# and never has more than max_connections open in total.  Callers beyond
+# that wait for a connection to be free.
+
+import httplib
+import socket
+import threading
+import urlparse
+
+
+def split_url(url):
+    "Returns (scheme, netloc, path with query) for an http or https URL."
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    if scheme not in ('http', 'https'):
+        raise ValueError('Not an http or https URL: %r' % url)
+    if not path:
+        path = '/'
+    if query:
+        path += '?' + query
+    return scheme, netloc, path
+
+
+# httplib here has no timeout argument, so connect() sets the default socket
+# timeout while it connects.  This serializes the changes to it.
+_timeout_lock = threading.Lock()
+
+def connect(scheme, netloc, timeout=None):
+    """Opens an httplib connection.  The timeout covers the connect as well,
+    so a host that never answers can't hold the caller up forever."""
+    if scheme == 'https':
+        conn = httplib.HTTPSConnection(netloc)
+    else:
+        conn = httplib.HTTPConnection(netloc)
+    if timeout is None:
+        conn.connect()
+        return conn
+    _timeout_lock.acquire()
+    try:
+        old_timeout = socket.getdefaulttimeout()
+        socket.setdefaulttimeout(timeout)
+        try:
+            conn.connect()
+        finally:
+            socket.setdefaulttimeout(old_timeout)
+    finally:
+        _timeout_lock.release()
+    conn.sock.settimeout(timeout)
+    return conn
+
+
+class ConnectionPool(object):
+    "A bounded pool of keep-alive HTTP connections, safe to share by threads."
+
+    def __init__(self, max_connections=4, timeout=60):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.slots = threading.Semaphore(max_connections)
+        self.lock = threading.Lock()
+        self.idle = []      # (key, connection), least recently used first
+
+    def request(self, method, url, body=None, headers=None):
+        "Makes a request and returns (status, response body)."
+        if headers is None:
+            headers = {}
+        scheme, netloc, path = split_url(url)
+        key = (scheme, netloc)
+        self.slots.acquire()
+        try:
+            conn = self._take(key)
+            if conn is not None:
+                try:
+                    return self._request(key, conn, method, path, body,
+                            headers)
+                except (httplib.HTTPException, socket.error):
+                    # Most likely the server closed the idle connection.
+                    # Try once more on a new one.
+                    conn.close()
+            conn = connect(scheme, netloc, self.timeout)
+            try:
+                return self._request(key, conn, method, path, body, headers)
+            except:
+                conn.close()
+                raise
+        finally:
+            self.slots.release()
+
+    def _request(self, key, conn, method, path, body, headers):
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        data = response.read()
+        if response.will_close:
+            conn.close()
+        else:
+            self._put(key, conn)
+        return response.status, data
+
+    def _take(self, key):
+        "Returns an idle connection to key, if there is one."
+        self.lock.acquire()
+        try:
+            for i in range(len(self.idle) - 1, -1, -1):
+                if self.idle[i][0] == key:
+                    return self.idle.pop(i)[1]
+            return None
+        finally:
+            self.lock.release()
+
+    def _put(self, key, conn):
+        "Keeps a connection for reuse, closing the oldest over the limit."
+        self.lock.acquire()
+        try:
+            self.idle.append((key, conn))
+            while len(self.idle) > self.max_connections:
+                self.idle.pop(0)[1].close()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        "Closes all the idle connections."
+        self.lock.acquire()
+        try:
+            for key, conn in self.idle:
+                conn.close()
+            self.idle = []
+        finally:
+            self.lock.release()
@@ -0,0 +1,204 @@
+#! /usr/bin/python
+
+# Copyright (c) 2010 John McLaughlin -- Mass Animation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Where the request signing hashkey comes from.
+#
+# The default hashkey is the local DNS name.  The main idea is that we want a
+# hashkey that is easily accessible, but hard to guess. The local DNS fits the
+# bill because an intruder needs to know both the the public and private DNS
+# names to get access to the JSONRPC service.  Instance tags were considered
+# but they require the AWS_SECRET_ACCESS_KEY to get.  My feeling is that the
+# extra security provided to this instance by using the AWS secret key, isn't
+# worth the risk of exposing the key.
+#
+# A better key can be put in the environment, in a file, or in the instance
+# "user-data".  The sources are tried in the order of key_sources.  The first
+# one that answers wins.
+#
+# Looking the key up used to cost an HTTP request to the meta-data service on
+# every single request.  Now it is looked up once and kept both in the process
+# and in key_cache_file (with the effective uid added to the name), and
+# only looked up again after key_refresh seconds.  If the lookup fails (slow
+# or broken meta-data service) the old key is used.  /tmp is open to every
+# user, so a cache file that isn't ours and private (mode 0600) is ignored,
+# or anyone on the machine could plant a key and sign requests with it.
+#
+# For testing, point JSONRPC_METADATA_URL at a local stub of the meta-data
+# service, or just set JSONRPC_HASHKEY.
+
+import os
+import time
+import tempfile
+import socket
+import urllib2
+
+# The first source that answers wins, so to use 'user-data' it has to go
+# before 'metadata', which always answers on EC2.
+key_sources = ['env', 'file', 'metadata']
+key_env = 'JSONRPC_HASHKEY'
+key_file = '/etc/jsonrpc_hashkey'
+key_cache_file = '/tmp/jsonrpc_hashkey'
+key_refresh = 3600      # seconds
+metadata_url = os.environ.get('JSONRPC_METADATA_URL',
+        'http://169.254.169.254/latest')
+metadata_timeout = 5    # seconds
+
+
+class KeyProvider(object):
+    "Resolves the hashkey once and caches it in the process and on disk."
+
+    def __init__(self, sources=None, cache_file=None,
+            refresh=key_refresh, base_url=metadata_url):
+        if sources is None:
+            sources = key_sources
+        if cache_file is None:
+            cache_file = '%s-%d' % (key_cache_file, os.geteuid())
+        self.sources = sources
+        self.cache_file = cache_file
+        self.refresh = refresh
+        self.base_url = base_url
+        self.key = None
+        self.key_time = 0
+
+    def get_key(self):
+        "Returns the hashkey, only going to the sources when it is stale."
+        if 'env' in self.sources and self._from_env():
+            return self._from_env()     # Free to look up, never cached.
+        now = time.time()
+        if self.key is not None and now < self.key_time + self.refresh:
+            return self.key
+
+        if self.key is None:
+            self._read_cache()
+            if self.key is not None and now < self.key_time + self.refresh:
+                return self.key
+
+        try:
+            key = self.resolve()
+        except Exception:
+            if self.key is not None:
+                # Better a slightly old key than no service.
+                return self.key
+            raise
+        self.key = key
+        self.key_time = now
+        self._write_cache()
+        return key
+
+    def resolve(self):
+        "Asks each of the sources in turn for the key."
+        for source in self.sources:
+            getter = getattr(self, '_from_' + source.replace('-','_'))
+            key = getter()
+            if key:
+                return key
+        raise LookupError('No hashkey source available: %s' % self.sources)
+
+    def _from_env(self):
+        return os.environ.get(key_env)
+
+    def _from_file(self):
+        try:
+            f = open(key_file)
+            try:
+                return f.read().strip()
+            finally:
+                f.close()
+        except IOError:
+            return None
+
+    def _from_user_data(self):
+        try:
+            return self._fetch(self.base_url + '/user-data')
+        except urllib2.HTTPError:
+            return None     # 404 when the instance has no user-data.
+
+    def _from_metadata(self):
+        return self._fetch(self.base_url + '/meta-data/local-hostname')
+
+    def _fetch(self, url):
+        old_timeout = socket.getdefaulttimeout()
+        socket.setdefaulttimeout(metadata_timeout)
+        try:
+            ud = urllib2.urlopen(url)
+            try:
+                return ud.read()
+            finally:
+                ud.close()
+        finally:
+            socket.setdefaulttimeout(old_timeout)
+
+    def _read_cache(self):
+        try:
+            fd = os.open(self.cache_file,
+                    os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+            try:
+                st = os.fstat(fd)
+                if st.st_uid != os.geteuid() or st.st_mode & 0777 != 0600:
+                    return  # Not one we wrote.
+                key_time = st.st_mtime
+                chunks = []
+                while True:
+                    data = os.read(fd, 4096)
+                    if not data:
+                        break
+                    chunks.append(data)
+                key = ''.join(chunks)
+            finally:
+                os.close(fd)
+        except (IOError, OSError):
+            return
+        if key:
+            self.key = key
+            self.key_time = key_time
+
+    def _write_cache(self):
+        # Written to a new private file (mkstemp opens it O_EXCL, mode 0600)
+        # and renamed into place, so a reader never sees half a key and
+        # nobody can point the write somewhere else with a symlink.
+        try:
+            fd, tmp_file = tempfile.mkstemp(
+                    prefix=os.path.basename(self.cache_file) + '.',
+                    dir=os.path.dirname(self.cache_file))
+        except (IOError, OSError):
+            return
+        try:
+            try:
+                os.write(fd, self.key)
+            finally:
+                os.close(fd)
+            os.rename(tmp_file, self.cache_file)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+
+
+_provider = None
+
+def get_hashkey():
+    "Returns the hashkey from this process's KeyProvider."
+    global _provider
+    if _provider is None:
+        _provider = KeyProvider()
+    return _provider.get_key()
@@ -0,0 +1,172 @@
+#! /usr/bin/python
+
+# Copyright (c) 2010 John McLaughlin -- Mass Animation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Streaming multipart/form-data parser for file uploads.
+#
+# cgi.FieldStorage copies every uploaded file into a temp file of its own, and
+# the handler used to copy that again into the tmpdir.  This parser writes
+# each file part straight into a spool directory as it comes off the socket,
+# a chunk at a time.  The spool directory is on the same file system as the
+# tmpdirs, so once the request signature checks out the files are just
+# renamed into place.  One disk write per upload and bounded memory.
+
+import os
+import cgi
+
+read_chunk = 65536
+
+# Largest non-file part (e.g. the "jsonrpc" request) kept in memory.
+max_field_size = 10000000
+
+# Largest part header block.
+max_header_size = 65536
+
+
+class MultipartError(ValueError):
+    "The multipart/form-data body couldn't be parsed."
+    pass
+
+
+class MultipartSpooler(object):
+    """Parses a multipart/form-data body from fp.
+
+    After parse(), fields maps the names of the ordinary parts to their
+    values, and uploads is a list of (filename, spool_path) for the file
+    parts, in the order they were sent."""
+
+    def __init__(self, fp, boundary, content_length, spool_dir):
+        self.fp = fp
+        self.remaining = content_length
+        self.spool_dir = spool_dir
+        self.delimiter = '--' + boundary
+        self.separator = '\r\n--' + boundary
+        self.buf = ''
+        self.fields = {}
+        self.uploads = []
+
+    def _fill(self):
+        "Reads more of the body into buf.  False at the end of the body."
+        if self.remaining is not None:
+            if self.remaining <= 0:
+                return False
+            data = self.fp.read(min(read_chunk, self.remaining))
+            self.remaining -= len(data)
+        else:
+            data = self.fp.read(read_chunk)
+        if not data:
+            return False
+        self.buf += data
+        return True
+
+    def _read_until(self, marker, limit):
+        "Returns everything up to marker and drops the marker."
+        while True:
+            i = self.buf.find(marker)
+            if i >= 0:
+                data = self.buf[:i]
+                self.buf = self.buf[i+len(marker):]
+                return data
+            if len(self.buf) > limit:
+                raise MultipartError('Part header too long.')
+            if not self._fill():
+                raise MultipartError('Unexpected end of body.')
+
+    def _copy_part(self, outfd):
+        """Copies the current part's body to outfd (or collects it if outfd is
+        None) up to the next separator."""
+        keep = len(self.separator) - 1
+        collected = []
+        size = 0
+        while True:
+            i = self.buf.find(self.separator)
+            if i >= 0:
+                data = self.buf[:i]
+                self.buf = self.buf[i+len(self.separator):]
+            else:
+                # The separator might straddle two reads, so hold back its
+                # length's worth of bytes.
+                data = self.buf[:-keep]
+                self.buf = self.buf[len(data):]
+            if outfd is not None:
+                outfd.write(data)
+            else:
+                size += len(data)
+                if size > max_field_size:
+                    raise MultipartError('Form field too large.')
+                collected.append(data)
+            if i >= 0:
+                return ''.join(collected)
+            if not self._fill():
+                raise MultipartError('Unexpected end of body.')
+
+    def parse(self):
+        "Reads the whole body."
+        # Skip the preamble.
+        self._read_until(self.delimiter, len(self.delimiter) + max_header_size)
+        part_num = 0
+        while True:
+            while len(self.buf) < 2 and self._fill():
+                pass
+            if self.buf[:2] == '--':
+                break   # Final delimiter.
+            header_block = self._read_until('\r\n\r\n', max_header_size)
+            name, filename = self._disposition(header_block)
+            if filename is None:
+                value = self._copy_part(None)
+                if name is not None:
+                    self.fields[name] = value
+                continue
+            filename = self._safe_filename(filename)
+            if not filename:
+                self._copy_part(None)   # An empty file input.
+                continue
+            part_num += 1
+            spool_path = '%s/%d' % (self.spool_dir, part_num)
+            outfd = open(spool_path, 'wb')
+            try:
+                self._copy_part(outfd)
+            finally:
+                outfd.close()
+            self.uploads.append((filename, spool_path))
+        # Whatever follows the final delimiter is ignored, but it still has
+        # to be read off the connection.
+        while self._fill():
+            self.buf = ''
+
+    def _disposition(self, header_block):
+        "Returns (name, filename) from the part's Content-Disposition."
+        for line in header_block.split('\r\n'):
+            if ':' not in line:
+                continue
+            key, value = line.split(':', 1)
+            if key.strip().lower() != 'content-disposition':
+                continue
+            pdict = cgi.parse_header(value.strip())[1]
+            return pdict.get('name'), pdict.get('filename')
+        return None, None
+
+    def _safe_filename(self, filename):
+        "Browsers may send a full client side path.  Keep just the name."
+        filename = filename.replace('\\', '/').split('/')[-1]
+        if filename in ('.', '..'):
+            return ''
+        return filename
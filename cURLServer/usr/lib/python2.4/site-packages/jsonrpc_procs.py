@@ -22,11 +22,21 @@
 
 import sys, time, os, shutil
 import sys
-import simplejson as json
+import jsonrpc_codec as json
 import subprocess
 import os
 import jsonrpcbase
 import inspect
+import urlparse
+import threading
+import thread
+import tempfile
+import sha
+from jsonrpc_cache import DownloadCache, release_link
+import jsonrpc_pycurl
+import jsonrpc_segments
+from jsonrpc_segments import SegmentedDownload
+import jsonrpc_relay
 
 #import cgitb
 #cgitb.enable()
@@ -39,20 +49,513 @@ def listdir():
     return result 
 
 
-def curl(*args):
-    curl_path = '/usr/bin/curl'
+curl_path = '/usr/bin/curl'
+
+# Size of the reads when streaming curl output.
+stream_chunk = 65536
+
+def curl_popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE):
+    "Starts /usr/bin/curl with the given argument list."
+    release_outputs(args)
     curl_list = [curl_path]
     for arg in args:
         # Rof loop just in case we want to filter args in future.
         curl_list.append(arg)
-    curl_result = subprocess.Popen(
-                 curl_list,
-                 stderr=subprocess.PIPE,
-                 stdout=subprocess.PIPE).communicate()[0]
+    return subprocess.Popen(curl_list, stderr=stderr, stdout=stdout)
+
+# 'pycurl' runs curl calls inside the process with libcurl (see
+# jsonrpc_pycurl.py), when pycurl is installed and the call only uses
+# options it knows.  That saves a fork and exec per call and reuses
+# connections between calls.  Everything else still runs curl_path.
+curl_engine = 'subprocess'
+
+_curl_engine = None
+
+def pycurl_engine():
+    "The in-process engine, or None if it isn't configured or available."
+    global _curl_engine
+    if curl_engine != 'pycurl' or jsonrpc_pycurl.pycurl is None:
+        return None
+    if _curl_engine is None:
+        _curl_engine = jsonrpc_pycurl.CurlEngine()
+    return _curl_engine
+
+def _output_files(args):
+    "The files curl writes its downloads to (-o and -O) for these args."
+    outputs = []
+    remote_name = False
+    urls = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in ('-o', '--output') or (arg[:1] == '-' and
+                arg[1:2] != '-' and len(arg) > 2 and arg[-1] == 'o'):
+            if i + 1 < len(args):
+                outputs.append(args[i+1])
+            i += 2
+            continue
+        if arg == '--remote-name' or (arg[:1] == '-' and arg[1:2] != '-' and
+                'O' in arg):
+            remote_name = True
+        elif '://' in arg:
+            urls.append(arg)
+        i += 1
+    if remote_name:
+        for url in urls:
+            outputs.append(urlparse.urlsplit(url)[2].split('/')[-1])
+    return [path for path in outputs if path and path != '-']
+
+def release_outputs(args):
+    """Removes any download cache links (see jsonrpc_cache.py) in the way of
+    curl's output files, which it couldn't write over (EACCES)."""
+    for path in _output_files(args):
+        release_link(path)
+
+def run_curl(args):
+    "Runs curl with args on the configured engine.  Returns its stdout."
+    engine = pycurl_engine()
+    if engine is not None:
+        try:
+            release_outputs(args)
+            return engine.run(args)
+        except jsonrpc_pycurl.Unsupported:
+            pass
+    return curl_popen(args).communicate()[0]
+
+# Shared download cache (see jsonrpc_cache.py) for curl calls that are a
+# plain GET to a file, e.g. '/tmp/jsonrpc_cache'.  None turns it off.
+curl_cache_dir = None
+curl_cache_max = 1 << 30    # bytes
+
+# Options that don't change what a GET fetches or where it goes.
+_cache_flags = {'-s': 1, '-S': 1, '-L': 1, '-f': 1, '--silent': 1,
+        '--show-error': 1, '--location': 1, '--fail': 1}
+
+def _parse_curl_args(args):
+    """Returns (url, headers, output, flags) if the curl arguments are a
+    simple GET of one http(s) URL into a file, otherwise None."""
+    url = output = None
+    remote_name = False
+    headers = []
+    flags = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in ('-o', '--output', '-H', '--header'):
+            if i + 1 >= len(args):
+                return None
+            if arg in ('-o', '--output'):
+                output = args[i+1]
+            else:
+                headers.append(args[i+1])
+            i += 2
+            continue
+        if arg in ('-O', '--remote-name'):
+            remote_name = True
+        elif arg in _cache_flags:
+            flags.append(arg)
+        elif arg[:1] == '-' and arg[1:2] != '-' and len(arg) > 2:
+            # Bundled short options, e.g. -sSL.
+            for c in arg[1:]:
+                if '-' + c not in _cache_flags:
+                    return None
+            flags.append(arg)
+        elif url is None and (arg.startswith('http://') or
+                arg.startswith('https://')):
+            url = arg
+        else:
+            return None
+        i += 1
+    if url is None or '[' in url or '{' in url:
+        return None     # No URL, or curl's URL globbing.
+    if remote_name:
+        if output is not None:
+            return None
+        output = urlparse.urlsplit(url)[2].split('/')[-1]
+    if not output or output == '-':
+        return None
+    return url, headers, output, flags
+
+_download_cache = None
+
+# Async jobs keep a journal of their curl, curl_multi and relay calls in
+# tmpdir/_journal, so that when the daemon re-runs a job that was interrupted
+# (see jsonrpc_daemon.py) the calls that had finished are skipped, and a plain
+# download that was cut off carries on from the end of the partial file
+# (curl -C -) instead of starting again from byte zero.  The daemon sets
+# these in the worker process.  curl_segmented isn't journalled: it only
+# downloads, and carries on from its own state file anyway.
+curl_journal = None     # path of the journal, None for no journal
+resuming = False        # True when the job is being re-run
+
+# Outputs up to this size are kept in the journal, so a finished call can
+# be answered from it.  Calls with bigger output are run again, except ones
+# that send data, which answer with no output rather than send it twice.
+journal_output_max = 4096
+
+# A call that was cut off may already have had its effect (a form posted, a
+# file uploaded), so when the job is re-run such a call fails rather than
+# being sent a second time, unless this is True.
+journal_replay_uploads = False
+
+# Options that make a curl call send data.
+_upload_options = {'-F': 1, '--form': 1, '--form-string': 1, '-d': 1,
+        '--data': 1, '--data-ascii': 1, '--data-binary': 1,
+        '--data-urlencode': 1, '-T': 1, '--upload-file': 1}
+
+def _sends_data(args):
+    "True if a curl call uploads or posts anything, or isn't a GET or HEAD."
+    for i in range(len(args)):
+        arg = args[i]
+        if arg in _upload_options or arg[:2] in ('-F', '-d', '-T'):
+            return True
+        if (arg in ('-X', '--request') and i + 1 < len(args) and
+                args[i+1].upper() not in ('GET', 'HEAD')):
+            return True
+    return False
+
+_journal_lock = threading.Lock()
+_journal_counts = {}
+
+def _journal_key(args):
+    """Journal key of a call.  The same arguments used twice in one job get
+    different keys."""
+    key = sha.new(json.dumps(args)).hexdigest()
+    _journal_lock.acquire()
+    try:
+        n = _journal_counts.get(key, 0)
+        _journal_counts[key] = n + 1
+    finally:
+        _journal_lock.release()
+    return '%s-%d' % (key, n)
+
+def _read_journal():
+    try:
+        f = open(curl_journal)
+        try:
+            return json.loads(f.read())
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return {}
+
+def _journal_entry(key, entry):
+    "Records a call's entry.  The journal is replaced with a rename."
+    _journal_lock.acquire()
+    try:
+        journal = _read_journal()
+        journal[key] = entry
+        tmp_file = '%s.%d' % (curl_journal, os.getpid())
+        f = open(tmp_file, 'w')
+        try:
+            f.write(json.dumps(journal))
+        finally:
+            f.close()
+        os.rename(tmp_file, curl_journal)
+    finally:
+        _journal_lock.release()
+
+def _resume_download(args):
+    """Carries on with a cut off download.  Returns curl's stdout, or None
+    if the call has to be run from the start."""
+    request = _parse_curl_args(args)
+    if request is None:
+        return None
+    output = request[2]
+    release_link(output)    # A complete cached copy, not a partial one.
+    try:
+        if os.path.getsize(output) == 0:
+            return None
+    except OSError:
+        return None
+    proc = curl_popen(list(args) + ['-C', '-'])
+    stdout = proc.communicate()[0]
+    if proc.returncode in (33, 36):
+        # The server can't do ranges, or the resume offset was bad.
+        os.remove(output)
+        return None
+    return stdout
+
+def _journalled(key_args, sends_data, run, resume=None, skipped=None,
+        trim=None):
+    """Runs a call, run(), under the journal.  key_args identify the call,
+    sends_data says whether it has effects beyond fetching (see
+    _sends_data).  On a rerun, a call that finished returns its journalled
+    result.  If that wasn't kept (it was over journal_output_max) the call is
+    run again, unless it sends data, in which case it returns skipped.  A cut
+    off call is carried on with resume() if given.  trim(result) makes a
+    smaller result to journal when the whole one is too big."""
+    if curl_journal is None:
+        return run()
+    key = _journal_key(key_args)
+    result = None
+    if resuming:
+        entry = _read_journal().get(key)
+        if entry is not None and entry.get('state') == 'done':
+            if 'output' in entry:
+                return entry['output']
+            if sends_data:
+                return skipped
+        elif entry is not None and entry.get('state') in ('started', 'failed'):
+            if sends_data and not journal_replay_uploads:
+                _journal_entry(key, {'state': 'failed'})
+                raise IOError('This call was cut off and may already have '
+                        'sent its data, so it is not sent again.')
+            if resume is not None:
+                result = resume()
+    if result is None:
+        _journal_entry(key, {'state': 'started'})
+        result = run()
+    entry = {'state': 'done'}
+    kept = result
+    if len(json.dumps(kept)) > journal_output_max and trim is not None:
+        kept = trim(result)
+    if len(json.dumps(kept)) <= journal_output_max:
+        entry['output'] = kept
+    _journal_entry(key, entry)
+    return result
+
+def curl(*args):
+    def run():
+        return _curl(args)
+    def resume():
+        return _resume_download(args)
+    # A finished upload whose output wasn't kept answers with no output.
+    return _journalled(args, _sends_data(args), run, resume, skipped='')
+
+def _curl(args):
+    global _download_cache
+    if curl_cache_dir is not None:
+        request = _parse_curl_args(args)
+        if request is not None:
+            if _download_cache is None:
+                _download_cache = DownloadCache(curl_cache_dir, curl_cache_max)
+            url, headers, output, flags = request
+            header_args = []
+            for header in headers:
+                header_args.extend(['-H', header])
+            def fetch(fetch_args):
+                return run_curl(header_args + fetch_args)
+            return _download_cache.fetch(url, headers, output, flags, fetch)
+    curl_result = run_curl(args)
     return curl_result 
 
+# Most transfers a "curl_multi" call runs at once.
+curl_multi_max = 8
+
+# Separates curl's own output from the -w statistics curl_multi asks for.
+_write_out_marker = '\n--curl_multi-write-out--'
+_write_out_format = _write_out_marker + \
+        '%{http_code} %{size_download} %{size_upload} %{time_total}'
+
+def _curl_error(stderr):
+    """The "curl: (N) ..." error lines from curl's stderr, without the
+    progress meter or anything else."""
+    lines = [line.strip() for line in stderr.replace('\r', '\n').split('\n')]
+    return '\n'.join([line for line in lines if line.startswith('curl: (')])
+
+def _multi_transfer(args):
+    "Runs one curl_multi transfer with curl_path.  Returns its result."
+    # -s -S: no progress meter, but still the error message.
+    proc = curl_popen(list(args) + ['-s', '-S', '-w', _write_out_format])
+    stdout, stderr = proc.communicate()
+    error = ''
+    if proc.returncode:
+        error = _curl_error(stderr)
+    result = {'exit_code': proc.returncode, 'error': error,
+            'http_code': 0, 'bytes_downloaded': 0, 'bytes_uploaded': 0,
+            'time': 0.0, 'output': stdout}
+    i = stdout.rfind(_write_out_marker)
+    if i >= 0:
+        result['output'] = stdout[:i]
+        stats = stdout[i+len(_write_out_marker):].split()
+        try:
+            result['http_code'] = int(stats[0])
+            result['bytes_downloaded'] = int(float(stats[1]))
+            result['bytes_uploaded'] = int(float(stats[2]))
+            result['time'] = float(stats[3])
+        except (IndexError, ValueError):
+            pass
+    return result
+
+def _trim_multi(result):
+    "curl_multi results without their output, to fit in the journal."
+    trimmed = []
+    for respond in result:
+        respond = respond.copy()
+        respond['output'] = ''
+        respond['output_dropped'] = True
+        trimmed.append(respond)
+    return trimmed
+
+def curl_multi(transfers, max_concurrent=None):
+    """Runs several curl transfers at once, each given as a curl argument
+    list, at most max_concurrent (up to curl_multi_max) at a time.  Returns
+    a list of results in request order, each with the exit_code, error,
+    http_code, bytes_downloaded, bytes_uploaded, time (seconds) and output
+    (stdout) of its transfer."""
+    cur_frame = inspect.currentframe()
+    rpc_frame = inspect.getouterframes(cur_frame)[1][0]
+    rpc_self = rpc_frame.f_locals['self']
+
+    limit = curl_multi_max
+    if max_concurrent is not None:
+        limit = max(1, min(int(max_concurrent), curl_multi_max))
+    sends_data = False
+    for args in transfers:
+        if not isinstance(args, list):
+            raise ValueError('Each transfer must be a curl argument list.')
+        if _sends_data(args):
+            sends_data = True
+
+    def run():
+        engine = pycurl_engine()
+        if engine is not None:
+            try:
+                for args in transfers:
+                    release_outputs(args)
+                return engine.run_multi(transfers, limit)
+            except jsonrpc_pycurl.Unsupported:
+                pass
+        result = []
+        for respond, e in rpc_self._run_concurrently(_multi_transfer,
+                transfers, limit):
+            if e is not None:
+                raise e
+            result.append(respond)
+        return result
+    return _journalled(['curl_multi'] + transfers, sends_data, run,
+            trim=_trim_multi)
+
+def relay(source, destination, filename=None, field='file',
+        content_type=None, form=None, checksum=None, source_headers=None,
+        destination_headers=None):
+    """relay (see jsonrpc_relay.py) under the journal, so that a job that is
+    re-run doesn't POST the file a second time."""
+    args = [source, destination, filename, field, content_type, form,
+            checksum, source_headers, destination_headers]
+    def run():
+        return jsonrpc_relay.relay(*args)
+    return _journalled(['relay'] + args, True, run)
+
+# Most range requests a "curl_segmented" call makes at once.
+curl_segmented_max = 8
+
+def curl_segmented(url, output, headers=None, connections=None):
+    """Downloads one large object to the file output with several HTTP Range
+    requests at once (see jsonrpc_segments.py).  headers is a list of extra
+    header lines, connections how many ranges to fetch at a time.  Calling
+    it again after a partial failure only fetches the missing segments."""
+    cur_frame = inspect.currentframe()
+    rpc_frame = inspect.getouterframes(cur_frame)[1][0]
+    rpc_self = rpc_frame.f_locals['self']
+
+    if headers is None:
+        headers = []
+    workers = jsonrpc_segments.segment_workers
+    if connections is not None:
+        workers = max(1, min(int(connections), curl_segmented_max))
+    release_link(output)
+    download = SegmentedDownload(url, output, headers, curl_popen,
+            rpc_self._run_concurrently, workers)
+    return download.run()
+
+# How much of the end of curl's stderr a StreamError keeps.
+stream_error_max = 4096
+
+class StreamError(Exception):
+    "curl exited with an error part way through a curl_stream()."
+    def __init__(self, exit_code, stderr):
+        Exception.__init__(self, 'curl exited with %d: %s' %
+                (exit_code, stderr))
+        self.exit_code = exit_code
+        self.stderr = stderr
+
+def curl_stream(*args):
+    """Generator version of curl.  Yields curl's stdout stream_chunk bytes at
+    a time, so the output never has to fit in memory.  This isn't a JSON-RPC
+    method; the handler uses it for the stream=1 option.  If curl fails,
+    raises StreamError after the last chunk, so the response is cut off
+    rather than looking complete."""
+    # stderr (the progress meter) goes to a temp file rather than a pipe,
+    # since nothing reads it until the end and curl would block once a
+    # pipe filled up.
+    # (No try/finally to close it: Python 2.4 can't yield inside one.  An
+    # unnamed temp file goes away with the generator anyway.)
+    errfile = tempfile.TemporaryFile()
+    proc = curl_popen(args, stderr=errfile)
+    chunk = proc.stdout.read(stream_chunk)
+    while chunk:
+        yield chunk
+        chunk = proc.stdout.read(stream_chunk)
+    proc.stdout.close()
+    exit_code = proc.wait()
+    stderr = ''
+    if exit_code:
+        errfile.seek(0, 2)
+        errfile.seek(max(errfile.tell() - stream_error_max, 0))
+        stderr = errfile.read().split('\r')[-1].strip()
+    errfile.close()
+    if exit_code:
+        raise StreamError(exit_code, stderr)
+
+# Size of the reads and writes when copying files, for cat and concat.
+concat_chunk = 1 << 20
+
+def _append_file(out_fd, path):
+    """Appends the file at path to out_fd, a chunk at a time (or in the
+    kernel with os.sendfile where Python has it).  Returns the number of
+    bytes."""
+    in_fd = os.open(path, os.O_RDONLY)
+    try:
+        total = 0
+        if hasattr(os, 'sendfile'):
+            while True:
+                sent = os.sendfile(out_fd, in_fd, total, concat_chunk)
+                if not sent:
+                    return total
+                total += sent
+        while True:
+            data = os.read(in_fd, concat_chunk)
+            if not data:
+                return total
+            while data:
+                written = os.write(out_fd, data)
+                total += written
+                data = data[written:]
+    finally:
+        os.close(in_fd)
+
+def _concatenate(out, paths):
+    """Writes the files at paths one after the other into out.  Returns
+    (total bytes, [[path, bytes], ...], [error message, ...]).  Like
+    /bin/cat, a file that can't be read is reported and skipped."""
+    release_link(out)
+    out_fd = os.open(out, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0666)
+    total = 0
+    files = []
+    errors = []
+    try:
+        out_stat = os.fstat(out_fd)
+        for path in paths:
+            try:
+                st = os.stat(path)
+                if (st.st_dev, st.st_ino) == (out_stat.st_dev,
+                        out_stat.st_ino):
+                    errors.append('cat: %s: input file is output file' % path)
+                    continue
+                n = _append_file(out_fd, path)
+            except (IOError, OSError), e:
+                errors.append('cat: %s: %s' % (path, e.strerror))
+                continue
+            files.append([path, n])
+            total += n
+    finally:
+        os.close(out_fd)
+    return total, files, errors
+
 def cat(*args):
-    cat_list = ['cat']
+    cat_list = []
     got_out = False
     out = ''
     for arg in args:
@@ -65,19 +568,64 @@ def cat(*args):
         if arg:
             cat_list.append(arg)
 
+    # Options (-n, -s, ...) and - for stdin are only understood by /bin/cat.
+    options = [arg for arg in cat_list if arg[:1] == '-']
+
     cat_result = ''
-    if got_out and out:
+    if got_out and out and options:
+        release_link(out)
         outfd = open(out,'w')
-        cat_result = subprocess.Popen( cat_list,
+        cat_result = subprocess.Popen(['cat'] + cat_list,
                  stderr=subprocess.PIPE,
                  stdout=outfd).communicate()[1]
         outfd.close()
+    elif got_out and out:
+        ## Copied natively rather than by /bin/cat, so the contents never
+        ## pass through here.  The result is the error output, as before.
+        errors = _concatenate(out, cat_list)[2]
+        if errors:
+            cat_result = '\n'.join(errors) + '\n'
     else:
-        cat_result = subprocess.Popen( cat_list,
+        cat_result = subprocess.Popen(['cat'] + cat_list,
                  stderr=subprocess.PIPE,
                  stdout=subprocess.PIPE).communicate()[0]
     return cat_result 
 
+def concat(output, *inputs):
+    """Concatenates the input files into output without reading them into
+    memory.  Returns the total bytes and the bytes of each file.  Unlike cat
+    it fails if any input can't be read, and then leaves output as it was:
+    the files are written to a temp file that is only renamed to output
+    once they are all in."""
+    try:
+        out_stat = os.stat(output)
+    except OSError:
+        out_stat = None
+    if out_stat is not None:
+        for path in inputs:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue    # Reported below.
+            if (st.st_dev, st.st_ino) == (out_stat.st_dev, out_stat.st_ino):
+                raise IOError('cat: %s: input file is output file' % path)
+
+    out_dir, out_name = os.path.split(output)
+    tmp_path = os.path.join(out_dir, '.%s.concat-%d-%d' % (out_name,
+            os.getpid(), thread.get_ident()))
+    try:
+        total, files, errors = _concatenate(tmp_path, inputs)
+        if errors:
+            raise IOError('; '.join(errors))
+        os.rename(tmp_path, output)
+    except:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return {'bytes': total, 'files': files}
+
 
 def sequence(*args):
     cur_frame = inspect.currentframe()
@@ -86,18 +634,51 @@ def sequence(*args):
     
     result = []
     for arg in args:
-        result.append(rpc_self.call_py(json.dumps(arg)))
+        result.append(rpc_self.call_py(arg))
 
     return result
 
 
+# Most sub-requests a "parallel" call runs at once.
+parallel_max = 8
+
+def parallel(*args):
+    """Like sequence, but the sub-requests run at the same time, in threads
+    sharing the same tmpdir.  Results still come back in request order.
+    Only use it for sub-requests that don't depend on each other; it can be
+    nested in a sequence for the ones that do."""
+    cur_frame = inspect.currentframe()
+    rpc_frame = inspect.getouterframes(cur_frame)[1][0]
+    rpc_self = rpc_frame.f_locals['self']
+
+    def call(arg):
+        return rpc_self.call_py(arg)
+
+    result = []
+    for respond, e in rpc_self._run_concurrently(call, args, parallel_max):
+        if e is not None:
+            raise e
+        result.append(respond)
+
+    return result
+
+
+# Set this above 1 to run the requests of a JSON-RPC batch (an array of
+# requests) at the same time, up to this many at once.
+batch_workers = 1
+
 def rpc_service_setup():
-    rpc_service = jsonrpcbase.JSONRPCService()
+    rpc_service = jsonrpcbase.JSONRPCService(batch_workers=batch_workers)
     rpc_service.add(ping)
     rpc_service.add(listdir)
     rpc_service.add(curl)
+    rpc_service.add(curl_multi)
+    rpc_service.add(curl_segmented)
+    rpc_service.add(relay)
     rpc_service.add(cat)
+    rpc_service.add(concat)
     rpc_service.add(sequence)
+    rpc_service.add(parallel)
     return rpc_service
 
 
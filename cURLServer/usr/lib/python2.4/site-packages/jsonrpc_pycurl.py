@@ -0,0 +1,364 @@
+#! /usr/bin/python
+
+# Copyright (c) 2010 John McLaughlin -- Mass Animation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# In-process libcurl engine for the "curl" method, using pycurl.
+#
+# Running /usr/bin/curl costs a fork and exec per call, and every call starts
+# from scratch: DNS lookup, TCP connect and TLS handshake, even when the last
+# call went to the same host.  CurlEngine runs the transfer inside the
+# process instead.  It keeps a pool of libcurl handles, which keep their
+# connections open between calls, and a CurlShare that shares the DNS cache
+# and TLS sessions between all of them.  run_multi() drives several
+# transfers at once from the same pool on a CurlMulti, for curl_multi.
+#
+# It understands the curl options that jobs commonly use (see translate()).
+# For anything else it raises Unsupported before doing anything, and
+# jsonrpc_procs.py runs /usr/bin/curl as before.  pycurl is optional: if it
+# isn't installed, pycurl is None here and the engine is never used.
+
+import threading
+import urlparse
+from cStringIO import StringIO
+
+try:
+    import pycurl
+except ImportError:
+    pycurl = None
+
+# libcurl handles kept for reuse.  More than this at once are made as
+# needed and thrown away afterwards.
+max_idle_handles = 8
+
+
+class Unsupported(Exception):
+    "The arguments use a curl option the engine doesn't handle."
+    pass
+
+
+# Options that take no value, and their settings.
+_switches = {
+        '-s': [], '--silent': [],
+        '-S': [], '--show-error': [],
+        '-L': [('FOLLOWLOCATION', 1), ('MAXREDIRS', 50)],
+        '--location': [('FOLLOWLOCATION', 1), ('MAXREDIRS', 50)],
+        '-f': [('FAILONERROR', 1)], '--fail': [('FAILONERROR', 1)],
+        '-k': [('SSL_VERIFYPEER', 0), ('SSL_VERIFYHOST', 0)],
+        '--insecure': [('SSL_VERIFYPEER', 0), ('SSL_VERIFYHOST', 0)],
+        '-i': [('HEADER', 1)], '--include': [('HEADER', 1)],
+        '-I': [('NOBODY', 1), ('HEADER', 1)],
+        '--head': [('NOBODY', 1), ('HEADER', 1)],
+        }
+
+# Options that take a value, and the libcurl option it goes to.
+_settings = {
+        '-X': 'CUSTOMREQUEST', '--request': 'CUSTOMREQUEST',
+        '-u': 'USERPWD', '--user': 'USERPWD',
+        '-A': 'USERAGENT', '--user-agent': 'USERAGENT',
+        '-e': 'REFERER', '--referer': 'REFERER',
+        '-r': 'RANGE', '--range': 'RANGE',
+        '-m': 'TIMEOUT', '--max-time': 'TIMEOUT',
+        '--connect-timeout': 'CONNECTTIMEOUT',
+        }
+
+_int_settings = {'TIMEOUT': 1, 'CONNECTTIMEOUT': 1}
+
+
+class Transfer(object):
+    "A curl argument list translated to libcurl options."
+
+    def __init__(self, args):
+        self.options = []       # (name, value)
+        self.headers = []
+        self.url = None
+        self.output = None
+        self.header_file = None
+        self.upload = None
+        self.data = []
+        self.translate(list(args))
+
+    def translate(self, args):
+        "Raises Unsupported for anything that isn't understood."
+        remote_name = False
+        while args:
+            arg = args.pop(0)
+            if arg in _switches:
+                self.options.extend(_switches[arg])
+            elif arg in ('-O', '--remote-name'):
+                remote_name = True
+            elif arg in _settings or arg in ('-o', '--output', '-H',
+                    '--header', '-D', '--dump-header', '-d', '--data',
+                    '--data-ascii', '--data-binary', '-T', '--upload-file'):
+                if not args:
+                    raise Unsupported(arg)
+                value = args.pop(0)
+                if arg in _settings:
+                    name = _settings[arg]
+                    if name in _int_settings:
+                        try:
+                            value = int(value)
+                        except ValueError:
+                            raise Unsupported(arg)
+                    self.options.append((name, value))
+                elif arg in ('-o', '--output'):
+                    self.output = value
+                elif arg in ('-H', '--header'):
+                    self.headers.append(value)
+                elif arg in ('-D', '--dump-header'):
+                    self.header_file = value
+                elif arg in ('-T', '--upload-file'):
+                    self.upload = value
+                elif value[:1] == '@':
+                    # curl strips newlines from -d @file, but not from
+                    # --data-binary @file.  Only the simple one is done here.
+                    if arg != '--data-binary':
+                        raise Unsupported(arg)
+                    f = open(value[1:], 'rb')
+                    try:
+                        self.data.append(f.read())
+                    finally:
+                        f.close()
+                else:
+                    self.data.append(value)
+            elif arg[:1] == '-' and arg[1:2] != '-' and len(arg) > 2:
+                # Bundled short switches, e.g. -sSL.
+                for c in arg[1:]:
+                    if '-' + c not in _switches:
+                        raise Unsupported(arg)
+                    self.options.extend(_switches['-' + c])
+            elif arg[:1] != '-' and self.url is None:
+                self.url = arg
+            else:
+                raise Unsupported(arg)
+
+        if self.url is None or '[' in self.url or '{' in self.url:
+            raise Unsupported('URL')    # None, or curl's URL globbing.
+        if '://' not in self.url:
+            self.url = 'http://' + self.url
+        if not self.url.startswith('http://') and \
+                not self.url.startswith('https://'):
+            raise Unsupported(self.url)
+        if self.data and self.upload is not None:
+            raise Unsupported('-d with -T')
+        if self.upload is not None and self.url.endswith('/'):
+            raise Unsupported('-T to a directory URL')
+        if remote_name:
+            if self.output is not None:
+                raise Unsupported('-O with -o')
+            self.output = urlparse.urlsplit(self.url)[2].split('/')[-1]
+            if not self.output:
+                raise Unsupported('-O without a file name')
+        if self.output == '-':
+            self.output = None
+
+
+class LazyFile(object):
+    "A file that is only created when the first data arrives, like curl's."
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def write(self, data):
+        if self.f is None:
+            self.f = open(self.path, 'wb')
+        self.f.write(data)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+
+
+class Running(object):
+    "The output files of a transfer in progress."
+
+    def __init__(self, transfer):
+        self.out = StringIO()
+        self.sink = self.out
+        self.header_sink = None
+        self.upload_fp = None
+        try:
+            if transfer.output is not None:
+                self.sink = LazyFile(transfer.output)
+            if transfer.header_file == '-':
+                # -D - is stdout, as with the curl command.
+                self.header_sink = self.out
+            elif transfer.header_file is not None:
+                self.header_sink = open(transfer.header_file, 'wb')
+            if transfer.upload is not None:
+                self.upload_fp = open(transfer.upload, 'rb')
+        except IOError:
+            self.close()
+            raise
+
+    def close(self):
+        "Closes the files, but not out, which is still to be read."
+        for f in (self.sink, self.header_sink, self.upload_fp):
+            if f is not None and f is not self.out:
+                f.close()
+
+
+class CurlEngine(object):
+    "Runs curl argument lists through a pool of reused libcurl handles."
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = []
+        self.share = pycurl.CurlShare()
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        if hasattr(pycurl, 'LOCK_DATA_SSL_SESSION'):
+            self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+
+    def run(self, args):
+        """Runs the transfer and returns what curl would have written to
+        stdout.  Unsupported if curl has to do it instead."""
+        transfer = Transfer(args)
+        handle = self._take()
+        try:
+            running = self._start(handle, transfer)
+            try:
+                try:
+                    handle.perform()
+                except pycurl.error:
+                    # Same as the command line: the error would only be on
+                    # stderr, which nobody sees.
+                    pass
+            finally:
+                running.close()
+        finally:
+            self._put(handle)
+        return running.out.getvalue()
+
+    def run_multi(self, arg_lists, limit):
+        """Runs several transfers at once on a CurlMulti, at most limit at a
+        time.  Returns a result dictionary for each, in order.  Unsupported,
+        before anything starts, if any of them can't be done here."""
+        transfers = [Transfer(args) for args in arg_lists]
+        results = [None] * len(transfers)
+        multi = pycurl.CurlMulti()
+        active = {}     # handle -> (index, Running)
+        next_i = 0
+        try:
+            while next_i < len(transfers) or active:
+                while next_i < len(transfers) and len(active) < limit:
+                    handle = self._take()
+                    try:
+                        running = self._start(handle, transfers[next_i])
+                    except IOError, e:
+                        self._put(handle)
+                        results[next_i] = {'exit_code': 23, 'error': str(e),
+                                'http_code': 0, 'bytes_downloaded': 0,
+                                'bytes_uploaded': 0, 'time': 0.0,
+                                'output': ''}
+                    else:
+                        multi.add_handle(handle)
+                        active[handle] = (next_i, running)
+                    next_i += 1
+
+                while True:
+                    ret, num_handles = multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+                while True:
+                    num_queued, ok_list, err_list = multi.info_read()
+                    for handle in ok_list:
+                        self._finish(multi, active, results, handle, 0, '')
+                    for handle, code, message in err_list:
+                        # Just libcurl's error, as curl -sS would print it.
+                        self._finish(multi, active, results, handle, code,
+                                'curl: (%d) %s' % (code, message))
+                    if not num_queued:
+                        break
+                if active:
+                    multi.select(1.0)
+        finally:
+            for handle, (i, running) in active.items():
+                multi.remove_handle(handle)
+                running.close()
+                self._put(handle)
+            multi.close()
+        return results
+
+    def _start(self, handle, transfer):
+        "Sets a handle up for a transfer.  Returns its Running."
+        running = Running(transfer)
+        handle.setopt(pycurl.URL, transfer.url)
+        handle.setopt(pycurl.NOSIGNAL, 1)   # Safe in threads.
+        for name, value in transfer.options:
+            handle.setopt(getattr(pycurl, name), value)
+        if transfer.headers:
+            handle.setopt(pycurl.HTTPHEADER, transfer.headers)
+        if transfer.data:
+            handle.setopt(pycurl.POSTFIELDS, '&'.join(transfer.data))
+        handle.setopt(pycurl.WRITEFUNCTION, running.sink.write)
+        if running.header_sink is not None:
+            handle.setopt(pycurl.HEADERFUNCTION, running.header_sink.write)
+        if running.upload_fp is not None:
+            fp = running.upload_fp
+            fp.seek(0, 2)
+            handle.setopt(pycurl.UPLOAD, 1)
+            handle.setopt(pycurl.INFILESIZE, fp.tell())
+            fp.seek(0)
+            handle.setopt(pycurl.READFUNCTION, fp.read)
+        return running
+
+    def _finish(self, multi, active, results, handle, code, message):
+        "Collects a finished transfer's result and frees its handle."
+        multi.remove_handle(handle)
+        i, running = active.pop(handle)
+        running.close()
+        results[i] = {'exit_code': code, 'error': message,
+                'http_code': handle.getinfo(pycurl.HTTP_CODE),
+                'bytes_downloaded': int(handle.getinfo(pycurl.SIZE_DOWNLOAD)),
+                'bytes_uploaded': int(handle.getinfo(pycurl.SIZE_UPLOAD)),
+                'time': handle.getinfo(pycurl.TOTAL_TIME),
+                'output': running.out.getvalue()}
+        self._put(handle)
+
+    def _take(self):
+        "An idle handle, or a new one."
+        self.lock.acquire()
+        try:
+            if self.idle:
+                return self.idle.pop()
+        finally:
+            self.lock.release()
+        handle = pycurl.Curl()
+        handle.setopt(pycurl.SHARE, self.share)
+        return handle
+
+    def _put(self, handle):
+        "Cleans a handle for the next transfer, keeping its connections."
+        try:
+            handle.reset()
+            handle.setopt(pycurl.SHARE, self.share)
+        except (AttributeError, pycurl.error):
+            handle.close()  # Too old a pycurl to reset handles.
+            return
+        self.lock.acquire()
+        try:
+            if len(self.idle) < max_idle_handles:
+                self.idle.append(handle)
+                return
+        finally:
+            self.lock.release()
+        handle.close()
@@ -0,0 +1,447 @@
+#! /usr/bin/python
+
+# Copyright (c) 2010 John McLaughlin -- Mass Animation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# The asynchronous queue shared by jsonrpc_handler.py (which puts items in)
+# and /etc/jsonrpc_daemon.py (which takes them out).
+#
+# Each item is a file in a lane directory under local_queue_dir, named by its
+# job id.  A job id is
+#
+#    <milliseconds since the epoch>-<counter>-<node id>
+#
+# e.g. 1286312400123-000000-3f2a9c1e.  The time and counter come from seq_file
+# under an flock(), and the time never goes backwards even if the clock does,
+# so on one machine the ids are unique and sort in the order they were handed
+# out, even when many land in the same millisecond.  The node id (a hash of
+# the host name) keeps ids from different instances apart.  The daemon can
+# keep an ordered in-memory index of each directory (QueueIndex) instead of
+# stat()ing every file to find the oldest.  The same id names the job's
+# status record and, unless the request gives its own, its tmpdir.
+#
+# After writing an item the handler pokes the daemon through the wakeup_fifo,
+# so the daemon can sleep in select() instead of polling the directory every
+# second.  The daemon still looks at the directory every poll_interval
+# seconds in case a poke is lost, e.g. when the daemon was restarted between
+# the write and the poke.
+#
+# The queue is split into priority lanes, one subdirectory of local_queue_dir
+# each, picked with the priority=<lane> option.  When more than one lane has
+# work waiting, the daemon takes items from them in proportion to their
+# weights (LaneScheduler), so a small interactive copy in the "high" lane
+# doesn't wait behind a backlog of "bulk" migrations, and the bulk work still
+# gets its share of the workers and never starves.
+#
+# An item is written under a dot name, which the daemon ignores, and renamed
+# into place when it is complete, so the daemon never reads half an item.
+# With the durable=1 option (or queue_durable) the file and the directory are
+# also fsync()ed before the handler answers, so an accepted job survives a
+# crash of the machine.  Items the daemon can't make sense of anyway are moved
+# to dead_letter_dir and their jobs marked failed, without holding up the
+# rest of the queue.
+#
+# Every job also has a small status record in status_dir, named by its job
+# id (the queue file name), which follows it from "queued" to "running" to
+# "done" or "failed".  Clients poll it with the job_status=<job_id> option.
+
+import os
+import re
+import time
+import errno
+import fcntl
+import select
+import socket
+import sha
+from collections import deque
+import jsonrpc_codec as json
+
+# This holds all the tasks.  They are pulled from this directory
+# with a FIFO execution style.
+local_queue_dir = '/tmp/jsonrpc_queue'
+
+# Priority lanes and their weights.  With all three busy, out of every 13
+# jobs started 8 come from "high", 4 from "normal" and 1 from "bulk".
+queue_lanes = [('high', 8), ('normal', 4), ('bulk', 1)]
+default_lane = 'normal'
+
+# fsync() every item before returning from enqueue().  Slower, but nothing
+# that was accepted is lost if the machine goes down.
+queue_durable = False
+
+# Items the daemon has taken from a lane but is holding back because a host
+# they use is busy.  They are moved here, one subdirectory per lane, rather
+# than kept only in the daemon's memory, so a restart puts them back in
+# their lanes instead of losing them.
+deferred_dir = local_queue_dir + '/deferred'
+
+# Queue items that couldn't be read, kept for a post mortem.
+dead_letter_dir = '/tmp/jsonrpc_dead'
+
+# Time and counter of the last job id handed out.
+seq_file = '/tmp/jsonrpc_queue.seq'
+
+# Named pipe used to wake up the daemon.  The contents are meaningless.
+wakeup_fifo = '/tmp/jsonrpc_queue.fifo'
+
+# Fallback directory check for the daemon, in seconds.
+poll_interval = 60
+
+# Identifies this machine in job ids.
+node_id = sha.new(socket.gethostname()).hexdigest()[:8]
+
+# Job status records.
+status_dir = '/tmp/jsonrpc_status'
+
+# Results up to this size are kept in the status record itself.  Bigger
+# ones are only in the job's tmpdir/_result file.
+inline_result_max = 4096
+
+job_id_re = re.compile(r'^\w[-\w.]*$')
+
+
+def lane_dir(lane):
+    "Queue directory of a lane.  ValueError for an unknown lane."
+    for name, weight in queue_lanes:
+        if name == lane:
+            return local_queue_dir + '/' + lane
+    raise ValueError('Unknown priority: %r' % lane)
+
+
+def enqueue(async_item, lane=default_lane, durable=None, job_id=None):
+    """Writes async_item to a lane of the queue, wakes the daemon, returns
+    the path.  If durable (default queue_durable) the item is on disk before
+    this returns.  A new job id is made unless one is given."""
+    if durable is None:
+        durable = queue_durable
+    if job_id is None:
+        job_id = new_job_id()
+    queue_dir = lane_dir(lane)
+    if not os.access(queue_dir, os.F_OK):
+        os.makedirs(queue_dir)
+    queue_path = queue_dir + '/' + job_id
+    write_status(job_id, state='queued', queued_at=time.time(), lane=lane,
+            tmpdir=async_item.get('tmpdir'),
+            callback=async_item.get('callback'))
+    tmp_path = '%s/.%s.%d' % (queue_dir, job_id, os.getpid())
+    f = open(tmp_path, 'w')
+    try:
+        f.write(json.dumps(async_item))
+        f.flush()
+        if durable:
+            os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmp_path, queue_path)
+    if durable:
+        fsync_dir(queue_dir)
+    notify()
+    return queue_path
+
+
+def defer(lane, name):
+    "Moves an item out of its lane into deferred_dir.  Returns the new path."
+    held_dir = deferred_dir + '/' + lane
+    if not os.access(held_dir, os.F_OK):
+        os.makedirs(held_dir)
+    held_path = held_dir + '/' + name
+    os.rename(lane_dir(lane) + '/' + name, held_path)
+    return held_path
+
+
+def restore_deferred():
+    "Puts the deferred items back in their lanes.  For daemon startup."
+    for lane, weight in queue_lanes:
+        held_dir = deferred_dir + '/' + lane
+        try:
+            names = os.listdir(held_dir)
+        except OSError:
+            continue
+        queue_dir = lane_dir(lane)
+        if not os.access(queue_dir, os.F_OK):
+            os.makedirs(queue_dir)
+        for name in names:
+            os.rename(held_dir + '/' + name, queue_dir + '/' + name)
+
+
+def fsync_dir(path):
+    "Makes the directory entries of path (e.g. a rename) durable."
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def dead_letter(queue_path, reason):
+    """Moves a queue item that can't be run to dead_letter_dir and marks its
+    job failed."""
+    job_id = os.path.basename(queue_path)
+    if not os.access(dead_letter_dir, os.F_OK):
+        os.makedirs(dead_letter_dir)
+    dead_path = dead_letter_dir + '/' + job_id
+    try:
+        os.rename(queue_path, dead_path)
+    except OSError:
+        dead_path = None    # Already gone.
+    write_status(job_id, state='failed', finished_at=time.time(),
+            error='Bad queue item: ' + reason, dead_letter=dead_path)
+
+
+def status_path(job_id):
+    "Path of a job's status record.  ValueError for a bad job id."
+    if not job_id_re.match(job_id):
+        raise ValueError('Bad job id: %r' % job_id)
+    return status_dir + '/' + job_id
+
+
+def read_status(job_id):
+    "Returns a job's status record, or None if there isn't one."
+    try:
+        f = open(status_path(job_id))
+    except IOError:
+        return None
+    try:
+        try:
+            return json.loads(f.read())
+        except ValueError:
+            return None
+    finally:
+        f.close()
+
+
+def write_status(job_id, **fields):
+    """Updates a job's status record with fields.  The record is replaced
+    with a rename, so readers never see half of one."""
+    status = read_status(job_id)
+    if status is None:
+        status = {'job_id': job_id}
+    status.update(fields)
+    status['updated_at'] = time.time()
+    if not os.access(status_dir, os.F_OK):
+        os.makedirs(status_dir)
+    path = status_path(job_id)
+    tmp_path = '%s/.%s.%d' % (status_dir, job_id, os.getpid())
+    f = open(tmp_path, 'w')
+    f.write(json.dumps(status))
+    f.close()
+    os.rename(tmp_path, path)
+    return status
+
+
+def active_paths():
+    """Generator over the tmpdirs and status files of the jobs that are
+    queued or running, for TmpdirCollector's in_use.  It reads one status
+    record per item and yields None for the ones that aren't active, so the
+    collector can spread the scan over its steps."""
+    try:
+        names = os.listdir(status_dir)
+    except OSError:
+        return
+    for job_id in names:
+        if not job_id_re.match(job_id):
+            continue        # Temporary files, and anything else.
+        status = read_status(job_id)
+        if status is None or status.get('state') not in ('queued', 'running'):
+            yield None
+            continue
+        yield status_dir + '/' + job_id
+        if status.get('tmpdir'):
+            yield os.path.normpath(status['tmpdir'])
+
+
+def new_job_id():
+    "Returns a new unique, time ordered job id.  Safe across processes."
+    now = int(time.time() * 1000)
+    fd = os.open(seq_file, os.O_RDWR|os.O_CREAT, 0600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        last = os.read(fd, 64).split()
+        if len(last) == 2:
+            last_ms, counter = int(last[0]), int(last[1])
+        else:
+            last_ms, counter = 0, 0     # New file, or an old style one.
+        if now > last_ms:
+            counter = 0
+        else:
+            # Same millisecond, or the clock went back.  Stay on the last
+            # time and count up.
+            now = last_ms
+            counter += 1
+            if counter > 999999:
+                now, counter = now + 1, 0
+        os.lseek(fd, 0, 0)
+        os.ftruncate(fd, 0)
+        os.write(fd, '%d %d\n' % (now, counter))
+    finally:
+        os.close(fd)    # Also drops the lock.
+    return '%013d-%06d-%s' % (now, counter, node_id)
+
+
+class QueueIndex(object):
+    """Ordered index of the queue directory for the daemon.
+
+    The directory is listed and sorted once per batch, then items come off
+    the front of a deque, so taking the next item doesn't touch the disk.
+    Once the directory has been found empty it isn't listed again until
+    invalidate() is called, i.e. until something may have been queued."""
+
+    def __init__(self, queue_dir=None):
+        if queue_dir is None:
+            queue_dir = local_queue_dir
+        self.queue_dir = queue_dir
+        self.pending = deque()
+        self.stale = True
+
+    def refill(self):
+        "Picks up everything that was queued since the last refill."
+        names = [n for n in os.listdir(self.queue_dir) if n[0] != '.']
+        names.sort()
+        self.pending = deque(names)
+        self.stale = False
+
+    def invalidate(self):
+        "Items may have been queued.  The next pop() on empty lists again."
+        self.stale = True
+
+    def pop(self):
+        "Returns the name of the oldest item, or None if the queue is empty."
+        if not self.has_items():
+            return None
+        return self.pending.popleft()
+
+    def has_items(self):
+        "True if pop() would return an item."
+        if not self.pending and self.stale:
+            self.refill()
+        return len(self.pending) > 0
+
+    def __len__(self):
+        return len(self.pending)
+
+
+class LaneScheduler(object):
+    """Takes items from the lanes' QueueIndexes in proportion to the lane
+    weights.
+
+    This is smooth weighted round robin: every turn each lane with work
+    waiting adds its weight to its credit, the lane with the most credit
+    goes next and pays back the total weight of the waiting lanes.  The
+    lanes come out interleaved (high, normal, high, high, normal, ...)
+    rather than in bursts, and any lane with work gets a turn within a
+    total-weight's worth of turns."""
+
+    def __init__(self, lanes=None):
+        if lanes is None:
+            lanes = queue_lanes
+        self.lanes = []
+        for name, weight in lanes:
+            queue_dir = lane_dir(name)
+            if not os.access(queue_dir, os.F_OK):
+                os.makedirs(queue_dir)
+            self.lanes.append([name, weight, 0, QueueIndex(queue_dir)])
+
+    def invalidate(self):
+        "Something was queued (the daemon was poked, or it polls anyway)."
+        for lane in self.lanes:
+            lane[3].invalidate()
+
+    def pop(self):
+        """Returns (lane, name) of the next item, or (None, None) if every
+        lane is empty."""
+        ready = [lane for lane in self.lanes if lane[3].has_items()]
+        if not ready:
+            return None, None
+        total = 0
+        best = None
+        for lane in ready:
+            lane[2] += lane[1]
+            total += lane[1]
+            if best is None or lane[2] > best[2]:
+                best = lane
+        best[2] -= total
+        return best[0], best[3].pop()
+
+
+def notify():
+    "Wakes up the daemon.  Never blocks and never fails."
+    try:
+        fd = os.open(wakeup_fifo, os.O_WRONLY|os.O_NONBLOCK)
+    except OSError:
+        # ENXIO: no daemon has the pipe open.  ENOENT: no pipe yet.
+        # Either way the daemon will find the item when it starts.
+        return
+    try:
+        try:
+            os.write(fd, '.')
+        except OSError:
+            pass    # EAGAIN: pipe full, so the daemon has plenty of pokes.
+    finally:
+        os.close(fd)
+
+
+class QueueWaiter(object):
+    "The daemon's end of the wakeup_fifo."
+
+    def __init__(self, fifo=wakeup_fifo):
+        self.fifo = fifo
+        try:
+            os.mkfifo(fifo, 0600)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Opened read/write so that there is always a writer, otherwise
+        # select() would keep reporting EOF after the first poke.
+        self.fd = os.open(fifo, os.O_RDWR|os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.fd
+
+    def wait(self, timeout=poll_interval, other_fds=()):
+        """Sleeps until poked, one of other_fds is readable, or timeout
+        seconds pass.  True if woken up before the timeout."""
+        try:
+            ready = select.select([self.fd] + list(other_fds), [], [],
+                    timeout)[0]
+        except select.error, e:
+            if e[0] == errno.EINTR:
+                return False
+            raise
+        if not ready:
+            return False
+        if self.fd in ready:
+            self.drain()
+        return True
+
+    def poked(self):
+        "True (and the pokes drained) if poked since the last wait."
+        return self.wait(0)
+
+    def drain(self):
+        "Throws away the accumulated pokes."
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,224 @@
+#! /usr/bin/python
+
+# Copyright (c) 2010 John McLaughlin -- Mass Animation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Download-to-upload relay, for the "relay" method.
+#
+# The usual way to move an object from S3 to somewhere like the GAE Blobstore
+# was a "curl -o file" followed by a "curl -F file=@file", so every byte went
+# through the disk twice.  Relay GETs the source and streams the body straight
+# into a multipart/form-data POST to the destination instead.  A reader
+# thread pulls relay_chunk pieces off the source into a Queue holding at most
+# relay_buffers of them, while the main thread sends them on, so the download
+# and the upload overlap and memory use stays bounded.
+#
+# If the source says how long it is, the POST has a Content-Length.
+# Otherwise it is sent chunked.  An md5 or sha1 of the body can be computed
+# on the way through.  For md5 it is also compared with the source's ETag
+# when that looks like a plain MD5, as S3's do for single-part uploads.
+
+import md5
+import sha
+import time
+import random
+import threading
+import Queue
+import httplib
+import urlparse
+from jsonrpc_http import split_url, connect
+
+relay_chunk = 65536
+relay_buffers = 16
+relay_timeout = 300     # seconds, per socket operation
+max_redirects = 5
+
+_hashes = {'md5': md5.new, 'sha1': sha.new}
+
+
+class RelayError(Exception):
+    pass
+
+
+def open_source(url, headers):
+    """Starts the GET, following redirects.  Returns (connection,
+    response)."""
+    for n in range(max_redirects + 1):
+        scheme, netloc, path = split_url(url)
+        conn = connect(scheme, netloc, relay_timeout)
+        conn.request('GET', path, None, headers)
+        response = conn.getresponse()
+        if response.status in (301, 302, 303, 307) and \
+                response.getheader('location'):
+            url = urlparse.urljoin(url, response.getheader('location'))
+            response.read()
+            conn.close()
+            continue
+        if response.status != 200:
+            conn.close()
+            raise RelayError('Source answered HTTP status %d.' %
+                    response.status)
+        return conn, response
+    raise RelayError('Too many redirects.')
+
+
+class Reader(threading.Thread):
+    "Reads the source body into a bounded queue.  None marks the end."
+
+    def __init__(self, response):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.response = response
+        self.queue = Queue.Queue(relay_buffers)
+        self.stopped = False
+        self.error = None
+
+    def run(self):
+        try:
+            while not self.stopped:
+                data = self.response.read(relay_chunk)
+                self._put(data or None)
+                if not data:
+                    return
+        except Exception, e:
+            self.error = e
+            self._put(None)
+
+    def _put(self, data):
+        while not self.stopped:
+            try:
+                self.queue.put(data, True, 1)
+                return
+            except Queue.Full:
+                pass
+
+    def chunks(self):
+        "Yields the body a chunk at a time."
+        while True:
+            data = self.queue.get()
+            if data is None:
+                if self.error is not None:
+                    raise RelayError('Source read failed: %s' % self.error)
+                return
+            yield data
+
+
+def _utf8(value):
+    "A form or header value from the JSON request as a UTF-8 byte string."
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def relay(source, destination, filename=None, field='file',
+        content_type=None, form=None, checksum=None, source_headers=None,
+        destination_headers=None):
+    """GETs source and POSTs its body to destination as the file field of a
+    multipart form, in one streaming pass.  Returns a summary."""
+    started = time.time()
+    if checksum is not None and checksum not in _hashes:
+        raise ValueError('checksum must be md5 or sha1.')
+    if filename is None:
+        filename = split_url(source)[2].split('?')[0].split('/')[-1] or 'file'
+
+    src_conn, src_response = open_source(source, source_headers or {})
+    try:
+        if content_type is None:
+            content_type = src_response.getheader('content-type',
+                    'application/octet-stream')
+        boundary = '----cURLServerRelay%d' % random.randint(0, 1 << 30)
+        # The values from the request are unicode.  They are encoded before
+        # the head is put together, so that its length is in bytes.
+        head = []
+        for name, value in (form or {}).items():
+            head.append('--%s\r\nContent-Disposition: form-data; '
+                    'name="%s"\r\n\r\n%s\r\n' %
+                    (boundary, _utf8(name), _utf8(value)))
+        head.append('--%s\r\nContent-Disposition: form-data; name="%s"; '
+                'filename="%s"\r\nContent-Type: %s\r\n\r\n' %
+                (boundary, _utf8(field), _utf8(filename).replace('"', ''),
+                _utf8(content_type)))
+        head = ''.join(head)
+        tail = '\r\n--%s--\r\n' % boundary
+
+        length = src_response.getheader('content-length')
+        headers = {}
+        for name, value in (destination_headers or {}).items():
+            headers[_utf8(name)] = _utf8(value)
+        headers['Content-Type'] = 'multipart/form-data; boundary=' + boundary
+        chunked = length is None
+        if chunked:
+            headers['Transfer-Encoding'] = 'chunked'
+        else:
+            headers['Content-Length'] = str(len(head) + int(length) +
+                    len(tail))
+
+        scheme, netloc, path = split_url(destination)
+        dst_conn = connect(scheme, netloc, relay_timeout)
+        reader = Reader(src_response)
+        digest = None
+        try:
+            dst_conn.putrequest('POST', path, skip_accept_encoding=1)
+            for name, value in headers.items():
+                dst_conn.putheader(name, value)
+            dst_conn.endheaders()
+
+            def send(data):
+                if chunked:
+                    dst_conn.send('%x\r\n%s\r\n' % (len(data), data))
+                else:
+                    dst_conn.send(data)
+
+            if checksum is not None:
+                digest = _hashes[checksum]()
+            size = 0
+            send(head)
+            reader.start()
+            for data in reader.chunks():
+                size += len(data)
+                if digest is not None:
+                    digest.update(data)
+                send(data)
+            send(tail)
+            if chunked:
+                dst_conn.send('0\r\n\r\n')
+            if not chunked and size != int(length):
+                raise RelayError('Source sent %d bytes, expected %s.' %
+                        (size, length))
+
+            response = dst_conn.getresponse()
+            result = {'status': response.status,
+                    'location': response.getheader('location'),
+                    'response': response.read(),
+                    'bytes': size,
+                    'time': time.time() - started}
+        finally:
+            reader.stopped = True
+            dst_conn.close()
+    finally:
+        src_conn.close()
+
+    if digest is not None:
+        result[checksum] = digest.hexdigest()
+        etag = (src_response.getheader('etag') or '').strip('"')
+        if checksum == 'md5' and len(etag) == 32 and '-' not in etag:
+            result['etag_match'] = etag.lower() == result['md5']
+    return result
@@ -0,0 +1,277 @@
+#! /usr/bin/python
+
+# Copyright (c) 2010 John McLaughlin -- Mass Animation
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Segmented download of one large object, for the "curl_segmented" method.
+#
+# One curl stream rarely fills the instance's bandwidth on a multi-GB S3
+# object.  SegmentedDownload asks for the first byte with a range request,
+# which gives the size (from Content-Range) and the ETag, sets the output file to its full size up front, then fetches
+# segment_size pieces of it with HTTP Range requests, several at once, each
+# written at its own offset.  Every range request carries If-Range with the
+# ETag, so if the object changes half way the server sends the whole thing
+# instead of a piece, and that segment fails rather than mixing two versions.
+#
+# Progress is kept in <output>.segments.  Failed segments are retried a few
+# times.  If some still fail, the call reports them and a later call with the
+# same output picks up where this one left off, as long as the object's size
+# and ETag haven't changed.  Each segment's byte count is checked against its
+# range as it arrives; when all are in, the state file is removed.
+#
+# The probe is a GET rather than a HEAD because presigned S3 URLs are signed
+# for one method, and a HEAD of a URL signed for GET is refused.  Servers
+# that don't do ranges (a 200 instead of a 206, or no total length) get a
+# plain single download instead.
+
+import os
+import time
+import signal
+import threading
+import jsonrpc_codec as json
+from jsonrpc_cache import parse_response_headers, read_response_headers
+
+segment_size = 64 << 20     # bytes
+segment_workers = 4
+segment_retries = 3
+
+# A range request that moves less than a byte a second for this long is
+# given up on (and retried), rather than holding up the whole download.
+segment_stall_time = 60     # seconds
+read_chunk = 65536
+
+
+class SegmentError(Exception):
+    pass
+
+
+def content_range_total(value):
+    "The total length from a Content-Range header, or None."
+    if not value or '/' not in value:
+        return None
+    try:
+        return int(value.split('/', 1)[1])
+    except ValueError:
+        return None         # "*", an unknown length.
+
+
+class SegmentedDownload(object):
+    """Downloads url to output in ranges.  popen(args, stdout=, stderr=)
+    starts curl, run_concurrently(f, items, limit) runs f over items in
+    threads, as JSONRPCService._run_concurrently does."""
+
+    def __init__(self, url, output, headers, popen, run_concurrently,
+            workers=None, size_of_segment=None):
+        self.url = url
+        self.output = output
+        self.state_file = output + '.segments'
+        self.header_args = []
+        for header in headers:
+            self.header_args.extend(['-H', header])
+        self.popen = popen
+        self.run_concurrently = run_concurrently
+        if workers is None:
+            workers = segment_workers
+        if size_of_segment is None:
+            size_of_segment = segment_size
+        self.workers = workers
+        self.segment_size = size_of_segment
+        self.lock = threading.Lock()
+        self.size = None
+        self.etag = None
+        self.done = {}
+
+    def run(self):
+        "Does the download.  Returns a summary for the method's result."
+        started = time.time()
+        status, headers = self.probe()
+        if status == 206:
+            self.size = content_range_total(headers.get('content-range'))
+        self.etag = headers.get('etag')
+        # An object of one segment or less (including an empty one, which
+        # has no valid range at all, so gets a 416) is just downloaded.
+        if (status != 206 or self.size is None or
+                self.size <= self.segment_size):
+            return self.single(started)
+
+        resumed = self.load_state()
+        if not resumed:
+            self.done = {}
+            f = open(self.output, 'ab')
+            try:
+                f.truncate(self.size)   # Preallocate.
+            finally:
+                f.close()
+            self.save_state()
+
+        segments = self.segment_count()
+        todo = [n for n in range(segments) if n not in self.done]
+        resumed_from = segments - len(todo)
+        errors = {}
+        tries = 0
+        while todo and tries <= segment_retries:
+            tries += 1
+            errors = {}
+            outcomes = self.run_concurrently(self.fetch_segment, todo,
+                    self.workers)
+            failed = []
+            for n, (value, e) in zip(todo, outcomes):
+                if e is not None:
+                    failed.append(n)
+                    errors[n] = str(e)
+            todo = failed
+
+        result = {'segmented': True, 'size': self.size, 'etag': self.etag,
+                'segments': segments, 'resumed_segments': resumed_from,
+                'time': time.time() - started}
+        if todo:
+            result['complete'] = False
+            result['failed_segments'] = [[n, errors.get(n)] for n in todo]
+            return result
+        try:
+            os.remove(self.state_file)
+        except OSError:
+            pass
+        result['complete'] = True
+        return result
+
+    def probe(self):
+        "Status and headers of a GET of the url's first byte."
+        proc = self.popen(['-s', '-L', '-r', '0-0', '-D', '-', '-o', os.devnull]
+                + self.header_args + [self.url])
+        return parse_response_headers(proc.communicate()[0])
+
+    def single(self, started):
+        "Plain download, for servers that can't do ranges."
+        devnull = open(os.devnull, 'w')
+        try:
+            proc = self.popen(['-s', '-f', '-L', '-o', self.output] +
+                    self.header_args + [self.url], stderr=devnull)
+            code = proc.wait()
+        finally:
+            devnull.close()
+        if code:
+            raise SegmentError('curl exit code %d.' % code)
+        return {'segmented': False, 'size': os.path.getsize(self.output),
+                'etag': self.etag, 'complete': True,
+                'time': time.time() - started}
+
+    def segment_count(self):
+        return max(1, (self.size + self.segment_size - 1) / self.segment_size)
+
+    def fetch_segment(self, n):
+        "Downloads segment n into place.  Raises SegmentError if it fails."
+        start = n * self.segment_size
+        end = min(start + self.segment_size, self.size) - 1
+        expected = end - start + 1
+        header_file = '%s.segment-%d' % (self.state_file, n)
+        args = ['-s', '-L', '-r', '%d-%d' % (start, end), '-D', header_file,
+                '-Y', '1', '-y', str(segment_stall_time)]
+        if self.etag:
+            args += ['-H', 'If-Range: ' + self.etag]
+        devnull = open(os.devnull, 'w')
+        try:
+            proc = self.popen(args + self.header_args + [self.url],
+                    stderr=devnull)
+        finally:
+            devnull.close()
+
+        fd = os.open(self.output, os.O_WRONLY)
+        received = 0
+        try:
+            os.lseek(fd, start, 0)
+            chunk = proc.stdout.read(read_chunk)
+            while chunk:
+                received += len(chunk)
+                if received > expected:
+                    # Most likely a 200 with the whole object.
+                    try:
+                        os.kill(proc.pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+                    break
+                os.write(fd, chunk)
+                chunk = proc.stdout.read(read_chunk)
+        finally:
+            os.close(fd)
+            proc.stdout.close()
+            code = proc.wait()
+
+        try:
+            try:
+                status, headers = read_response_headers(header_file)
+            except IOError:
+                status, headers = None, {}
+        finally:
+            try:
+                os.remove(header_file)
+            except OSError:
+                pass
+        if status != 206:
+            raise SegmentError('HTTP status %s.' % status)
+        if self.etag and headers.get('etag', self.etag) != self.etag:
+            raise SegmentError('ETag changed.')
+        if code or received != expected:
+            raise SegmentError('Got %d of %d bytes (curl exit code %d).' %
+                    (received, expected, code))
+
+        self.lock.acquire()
+        try:
+            self.done[n] = 1
+            self.save_state()
+        finally:
+            self.lock.release()
+
+    def load_state(self):
+        """Picks up the progress of an earlier call, if it was for the same
+        object.  True if it did."""
+        try:
+            f = open(self.state_file)
+            try:
+                state = json.loads(f.read())
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return False
+        if (state.get('url') != self.url or state.get('size') != self.size or
+                state.get('etag') != self.etag or
+                state.get('segment_size') != self.segment_size):
+            return False
+        try:
+            if os.path.getsize(self.output) != self.size:
+                return False
+        except OSError:
+            return False
+        self.done = {}
+        for n in state.get('done', []):
+            self.done[n] = 1
+        return True
+
+    def save_state(self):
+        tmp_file = '%s.%d' % (self.state_file, os.getpid())
+        f = open(tmp_file, 'w')
+        try:
+            f.write(json.dumps({'url': self.url, 'size': self.size,
+                    'etag': self.etag, 'segment_size': self.segment_size,
+                    'done': self.done.keys()}))
+        finally:
+            f.close()
+        os.rename(tmp_file, self.state_file)
@@ -75,16 +75,20 @@ Example:
 import sys
 import traceback
 import base64
+import threading
 # from functools import wraps
 
-# JSON library importing
+# JSON library importing.  The cURL Server's jsonrpc_codec picks the fastest one installed.
 try:
-    import json
+    import jsonrpc_codec as json
 except ImportError:
     try:
-        import simplejson as json
+        import json
     except ImportError:
-        raise ImportError('Your system has no json (included in Python v2.6 or later) or simplejson module available.')
+        try:
+            import simplejson as json
+        except ImportError:
+            raise ImportError('Your system has no json (included in Python v2.6 or later) or simplejson module available.')
 
 DEFAULT_JSONRPC = '2.0'
 
@@ -93,8 +97,14 @@ class JSONRPCService(object):
     The JSONRPCService class is a JSON-RPC
     """
     
-    def __init__(self):
+    def __init__(self, batch_workers=1):
+        """
+        Arguments:
+        batch_workers -- number of requests of a batch call that may run at the same time. With the default of 1 the
+                         requests of a batch run one after another.
+        """
         self.method_data = {}
+        self.batch_workers = batch_workers
 
     def add(self, f, name=None, types=None, required=None):
         """
@@ -119,46 +129,78 @@ class JSONRPCService(object):
         else:
             fname = name
 
-        self.method_data[fname] = {'method': f}
-        
+        # Everything dispatch needs to know about the method is worked out here, once, rather than on every call.
+        self.method_data[fname] = self._describe(f, types, required)
+
+    def _describe(self, f, types=None, required=None):
+        """
+        Returns the descriptor of a method: the callable, the bounds on its number of positional arguments, and
+        the argument types if given.
+        """
+        desc = {'method': f, 'min_args': 0, 'max_args': None}
+
+        func = getattr(f, 'im_func', f)
+        if hasattr(func, 'func_code'):
+            # A bound method's self is already supplied.
+            skip = 0
+            if getattr(f, 'im_self', None) is not None:
+                skip = 1
+            desc['min_args'] = max(self._man_args(func) - skip, 0)
+            if not self._vargs(func):
+                desc['max_args'] = self._max_args(func) - skip
+        # else a builtin or other callable that can't be introspected, so leave the argument checks to it.
+
         if types is not None:
-            self.method_data[fname]['types'] = types
-            
+            desc['types'] = types
+
             if required is not None:
-                self.method_data[fname]['required'] = required
+                desc['required'] = required
+
+        return desc
         
     def call(self, jsondata):
         """
         Calls jsonrpc service's method and returns its return value in a JSON string or None if there is none.
         
         Arguments:
-        jsondata -- remote method call in jsonrpc format
+        jsondata -- remote method call in jsonrpc format, either the JSON string or the already parsed request
+        """
+        return self.encode(self.call_py(jsondata))
+
+    def encode(self, respond):
         """
-        result = self.call_py(jsondata)
-        if result != None:
+        Returns the response from call_py() as a JSON string, or None if there is none.
+        
+        A result that isn't valid UTF-8 is sent base64 encoded instead.
+        """
+        if respond != None:
             try:
-                return json.dumps(result)
+                return json.dumps(respond)
             except UnicodeDecodeError:
-                if 'result' in result:
-                    b64result = base64.b64encode(result['result'])
-                    result['result'] = {"base64_encoded": b64result}
-                    return json.dumps(result)
+                if 'result' in respond:
+                    b64result = base64.b64encode(respond['result'])
+                    respond['result'] = {"base64_encoded": b64result}
+                    return json.dumps(respond)
         return None
 
     def call_py(self, jsondata):
         """
         Calls jsonrpc service's method and returns its return value in python object format or None if there is none.
         
-        This method is same as call() except the return value is a python object instead of JSON string. This method
-        is mainly only useful for debugging purposes.
+        This method is same as call() except the return value is a python object instead of JSON string. It is
+        also the way to pass on a request that is already parsed, e.g. a sub-request, without encoding and
+        decoding it again.
         """
-        try:
+        if isinstance(jsondata, basestring):
             try:
-                rdata = json.loads(jsondata)
-            except ValueError:
-                raise ParseError
-        except ParseError, e:
-            return self._get_err(e)
+                try:
+                    rdata = json.loads(jsondata)
+                except ValueError:
+                    raise ParseError
+            except ParseError, e:
+                return self._get_err(e)
+        else:
+            rdata = jsondata
 
         # set some default values for error handling
         request = self._get_default_vals()
@@ -195,10 +237,20 @@ class JSONRPCService(object):
                     
                     requests.append(request_)
                 
-                for request_ in requests:
-                    try:
-                        respond = self._handle_request(request_)
-                    except JSONRPCError, e:
+                if self.batch_workers > 1 and len(requests) > 1:
+                    outcomes = self._run_concurrently(self._handle_request, requests, self.batch_workers)
+                else:
+                    outcomes = []
+                    for request_ in requests:
+                        try:
+                            outcomes.append((self._handle_request(request_), None))
+                        except JSONRPCError, e:
+                            outcomes.append((None, e))
+
+                for request_, (respond, e) in zip(requests, outcomes):
+                    if e is not None:
+                        if not isinstance(e, JSONRPCError):
+                            raise e
                         responds.append(self._get_err(e,
                                                  request_['id'],
                                                  request_['jsonrpc']))
@@ -222,6 +274,40 @@ class JSONRPCService(object):
         except JSONRPCError, e:
             return self._get_err(e, request['id'], request['jsonrpc'])
 
+    def _run_concurrently(self, f, items, limit):
+        """
+        Calls f for each of the items using at most limit threads.
+        
+        Returns a list of (return value, None) or (None, exception) tuples in the same order as items.
+        """
+        outcomes = [None] * len(items)
+        pending = list(enumerate(items))
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                lock.acquire()
+                try:
+                    if not pending:
+                        return
+                    i, item = pending.pop(0)
+                finally:
+                    lock.release()
+                try:
+                    outcomes[i] = (f(item), None)
+                except Exception, e:
+                    outcomes[i] = (None, e)
+
+        threads = []
+        for n in range(min(limit, len(items))):
+            t = threading.Thread(target=worker)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+        return outcomes
+
     def _get_err(self, e, id=None, jsonrpc=DEFAULT_JSONRPC):
         """
         Returns jsonrpc error message.
@@ -278,10 +364,7 @@ class JSONRPCService(object):
         """
         Returns maximum number of arguments accepted by given function.
         """
-        if f.func_defaults is None:
-            return f.func_code.co_argcount
-
-        return f.func_code.co_argcount + len(f.func_defaults)
+        return f.func_code.co_argcount
 
     def _get_jsonrpc(self, rdata):
         """
@@ -337,7 +420,7 @@ class JSONRPCService(object):
         else:
             raise InvalidRequestError
 
-        if rdata['method'] not in self.method_data.keys():
+        if rdata['method'] not in self.method_data:
             raise MethodNotFoundError
 
         return rdata['method']
@@ -365,18 +448,18 @@ class JSONRPCService(object):
         request['method'] = self._get_method(rdata)
         request['params'] = self._get_params(rdata)
 
-    def _call_method(self, request):
+    def _call_method(self, request, desc):
         """Calls given method with given params and returns it value."""
-        method = self.method_data[request['method']]['method']
+        method = desc['method']
         params = request['params']
         result = None
         try:
             if isinstance(params, list):
                 # Does it have enough arguments?
-                if len(params) < self._man_args(method):
+                if len(params) < desc['min_args']:
                     raise InvalidParamsError
                 # Does it have too many arguments?
-                if not self._vargs(method) and len(params) > self._max_args(method):
+                if desc['max_args'] is not None and len(params) > desc['max_args']:
                     raise InvalidParamsError 
                 
                 result = method(*params)
@@ -398,10 +481,11 @@ class JSONRPCService(object):
 
     def _handle_request(self, request):
         """Handles given request and returns its response."""
-        if self.method_data[request['method']].has_key('types'):
-            self._validate_params_types(request['method'], request['params'])
+        desc = self.method_data[request['method']]
+        if desc.has_key('types'):
+            self._validate_params_types(desc, request['params'])
         
-        result = self._call_method(request)
+        result = self._call_method(request, desc)
 
         # Do not respond to notifications.
         if request['id'] is None:
@@ -420,29 +504,29 @@ class JSONRPCService(object):
         """
         return {"jsonrpc": DEFAULT_JSONRPC, "id": None}
     
-    def _validate_params_types(self, method, params):
+    def _validate_params_types(self, desc, params):
         """
-        Validates request's parameter types.
+        Validates request's parameter types against the method's descriptor.
         """
+        types = desc['types']
         if isinstance(params, list):
-            if not isinstance(self.method_data[method]['types'], list):
+            if not isinstance(types, list):
                 raise InvalidParamsError
             
-            for param, type in zip(params, self.method_data[method]['types']):
+            for param, type in zip(params, types):
                 if not isinstance(param, type):
                     raise InvalidParamsError
         elif isinstance(params, dict):
-            if not isinstance(self.method_data[method]['types'], dict):
+            if not isinstance(types, dict):
                 raise InvalidParamsError
             
-            if self.method_data[method].has_key('required'):
-                for key in self.method_data[method]['required']:
+            if desc.has_key('required'):
+                for key in desc['required']:
                     if not params.has_key(key):
                         raise InvalidParamsError
             
             for key in params.keys():
-                if not self.method_data[method]['types'].has_key(key) or \
-                not isinstance(params[key], self.method_data[method]['types'][key]):
+                if not types.has_key(key) or not isinstance(params[key], types[key]):
                     raise InvalidParamsError
             
 
@@ -170,6 +170,52 @@ class CurlTestAwake(CurlTestBase):
         self.assertEqual(result['result'][0]['result'],memcache.Client().get('CURL_TEST_SERVER_DNS'))
         self.assertEqual(result['result'][1]['result'],True)
         
+    def test_job_status(self):
+        """Test that an asynchronous request's status can be polled."""
+        request = {
+            'jsonrpc': '2.0',
+            'id': 20,
+            'method': 'ping'
+        }
+        response = self.send_request('&log=1&async=1',request)
+        job_id = json.loads(response.content)['result']['job_id']
+        i = 0
+        while i < 5:
+            i += 1
+            response = self.send_request('&job_status='+job_id,request)
+            status = json.loads(response.content)['result']
+            if status['state'] in ('done', 'failed'):
+                break
+            time.sleep(1)
+        self.assertEqual(status['state'],'done')
+        self.assertEqual(status['result']['result'],True)
+        
+    def test_parallel(self):
+        """Test that a simple "parallel" method works, and keeps the order."""
+        request = {
+            'jsonrpc': '2.0',
+            'id': 17,
+            'method': 'parallel',
+            'params': [
+                {
+                    'jsonrpc': '2.0',
+                    'id': 18,
+                    'method': 'curl',
+                    'params': ['http://169.254.169.254/latest/meta-data/public-hostname']
+                },
+                {
+                    'jsonrpc': '2.0',
+                    'id': 19,
+                    'method': 'ping'
+                }
+            ]
+        }
+        response = self.send_request('&log=1',request)
+        result = json.loads(response.content)
+        self.assertEqual(result['result'][0]['id'],18)
+        self.assertEqual(result['result'][0]['result'],memcache.Client().get('CURL_TEST_SERVER_DNS'))
+        self.assertEqual(result['result'][1]['result'],True)
+        
 
 
 
@@ -444,6 +490,42 @@ class CurlTestBlobS3(CurlTestBlob):
         except DeadlineExceededError:
             raise AsyncTestWaitError("Timed out while waiting for asynchronous request to respond.  You would never do this.  Try the test again.")    
 
+    def test_relay_from_s3(self):
+        
+        s3bkt = 'massanimation-testdata'
+        s3key = 'curl_test/mass_animation_label.png'
+        upload_as = 'shameless_massanimation_plug.png'
+        
+        expires = str(int(time.time() + 3600))
+        signature = aws_signature(s3bkt,s3key,
+                        expires,secret_access_key=AWS_SECRET_ACCESS_KEY)[0]
+        http_path = ('http://'+s3bkt+'.s3.amazonaws.com/'+s3key
+            + '?AWSAccessKeyId='+AWS_ACCESS_KEY_ID+'&Expires='+expires
+            + '&Signature='+signature )
+
+        item_key = str(self.item.key())
+        ## Same as test_upload_from_s3, but the object goes straight from
+        ## S3 to the Blobstore without being saved on the server.
+        request = { 
+            'jsonrpc': '2.0',
+            'id': 17,
+            'method': 'relay',
+            'params' : {
+                'source': http_path,
+                'destination': blobstore.create_upload_url(
+                        '/curl_test/finish_upload?key=' + item_key),
+                'filename': upload_as,
+                'content_type': 'image/png',
+                'checksum': 'md5'
+                }
+        }
+        response = self.send_request('',request)
+        result = json.loads(response.content)['result']
+        self.assertEqual(302, result['status'])
+        self.assertEqual(True, result['etag_match'])
+        self_item_refreshed = db.get(item_key)
+        self.assertEqual(upload_as,self_item_refreshed.myblob.filename)
+
 
 class CurlTestBlobUploadHandler (blobstore_handlers.BlobstoreUploadHandler):
     """ Handler for finishing the uploads to the Blobstore."""